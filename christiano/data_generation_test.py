@@ -17,11 +17,11 @@ print('policy ready')
 
 data = collect_annotations(env_fn, policy, 10, 25)
 
-assert len(data) == 10
+assert len(data.pairs) == len(data.labels) == 10
 print('correct number of pairs collected')
 
 
-assert(len(data[0].clip0) == len(data[0].clip1) == 25)
+assert data.clips.shape[1] == 25
 print('clips are of correct length')
 
 
@@ -29,11 +29,11 @@ abuffer = AnnotationBuffer(max_size = 10000)
 
 abuffer.add(data)
 abuffer.add(collect_annotations(env_fn, policy, 100, 25))
-assert abuffer.get_size() == 110
+assert abuffer.size == 110
 print('Adding data works, buffer size is correct')
 
-assert len(abuffer.sample_batch(5)) == 5
-assert len(abuffer.sample_val_batch(5)) == 5
+assert len(abuffer.sample_batch(5)[2]) == 5
+assert len(abuffer.sample_val_batch(5)[2]) == 5
 print('Sampling works, sample size is correct')
 
 
@@ -1,3 +1,6 @@
+import os, csv, json
+import multiprocessing
+
 import numpy as np
 import gym
 
@@ -27,6 +30,9 @@ class Gym_procgen_continuous(gym.Wrapper):
     self.env = self.env_fn()
     return self.env.reset()
 
+  def set_max_steps(self, max_steps):
+    self.max_steps = max_steps
+
   def step(self, action):
     """
     :param action: ([float] or int) Action taken by the agent
@@ -87,6 +93,9 @@ class Atari_continuous(gym.Wrapper):
     self.env = self.env_fn()
     return np.array(self.env.reset())
 
+  def set_max_steps(self, max_steps):
+    self.max_steps = max_steps
+
   def step(self, action):
     """
     :param action: ([float] or int) Action taken by the agent
@@ -128,24 +137,115 @@ class Vec_reward_wrapper(VecEnvWrapper):
     r_model must be a callable function that takes batch of obervations
     and returns batch of rewards
 
+    with deferred = True the steps return zero rewards and the observations
+    are kept, the rewards of all of them are computed at once by relabel()
+    (in batches of batch_size frames), which the rollout runner has to call
+
     """
 
-    def __init__(self, venv, r_model):
+    def __init__(self, venv, r_model, deferred = False, batch_size = 1024):
         VecEnvWrapper.__init__(self, venv)
         assert callable(r_model)
         self.r_model = r_model
+        self.deferred = deferred
+        self.batch_size = batch_size
+        self.pending_obs = []
 
     def reset(self):
         obs = self.venv.reset()
+        self.pending_obs = []
         return obs
 
     def step_wait(self):
         obs, rews, dones, infos = self.venv.step_wait()
+        if self.deferred:
+            self.pending_obs.append(obs.copy())
+            return obs, np.zeros(self.num_envs, dtype = np.float32), dones, infos
         proxy_rew = self.r_model(obs)
         return obs, proxy_rew, dones, infos
 
+    def relabel(self):
+        '''rewards of the steps since the last call, (n_steps, n_envs)'''
+        obs = np.stack(self.pending_obs)
+        self.pending_obs = []
+        frames = obs.reshape(-1, *obs.shape[2:])
+        rews = np.concatenate([np.reshape(self.r_model(frames[i:i + self.batch_size]), -1)
+                               for i in range(0, len(frames), self.batch_size)])
+        return rews.reshape(obs.shape[:2]).astype(np.float32)
+
     
 
+class ClipTap(VecEnvWrapper):
+    """
+    Keeps a reservoir sample of fixed-length clips of the rollouts passing
+    through, with their true returns, so that annotation pairs come for free
+    with policy training. Meant to sit below Vec_reward_wrapper.
+    All envs step together, so the clips of all envs end on the same step
+    """
+
+    def __init__(self, venv, clip_size, capacity=1000):
+        VecEnvWrapper.__init__(self, venv)
+        self.clip_size = clip_size
+        self.current = None
+        self.current_returns = np.zeros(self.num_envs)
+        self.t = 0
+        self.last_obs = None
+        self.set_capacity(capacity)
+
+    def set_capacity(self, capacity):
+        '''empties the reservoir, which then holds up to capacity clips'''
+        self.capacity = capacity
+        self.clips = None
+        self.returns = np.zeros(capacity)
+        self.n_stored = 0
+        self.n_seen = 0
+
+    def reset(self):
+        obs = self.venv.reset()
+        # a partial clip is dropped
+        self.t = 0
+        self.current_returns[:] = 0
+        self.last_obs = obs
+        return obs
+
+    def step_wait(self):
+        obs, rews, dones, infos = self.venv.step_wait()
+        if self.current is None:
+            self.current = np.empty((self.num_envs, self.clip_size, *obs.shape[1:]), dtype=np.uint8)
+        # same as in collect_annotations: a frame is recorded with the reward of the step taken from it
+        self.current[:, self.t] = self.last_obs
+        self.current_returns += rews
+        self.t += 1
+        if self.t == self.clip_size:
+            self._store()
+            self.t = 0
+            self.current_returns[:] = 0
+        self.last_obs = obs
+        return obs, rews, dones, infos
+
+    def _store(self):
+        if self.clips is None:
+            self.clips = np.empty((self.capacity, *self.current.shape[1:]), dtype=np.uint8)
+        for e in range(self.num_envs):
+            self.n_seen += 1
+            if self.n_stored < self.capacity:
+                slot = self.n_stored
+                self.n_stored += 1
+            else:
+                slot = np.random.randint(self.n_seen)
+                if slot >= self.capacity:
+                    continue
+            self.clips[slot] = self.current[e]
+            self.returns[slot] = self.current_returns[e]
+
+    def harvest(self):
+        '''the sampled clips and their true returns'''
+        if self.clips is None:
+            return np.zeros((0, self.clip_size), dtype=np.uint8), np.zeros(0)
+        return self.clips[:self.n_stored], self.returns[:self.n_stored]
+
+
+
 class Reward_wrapper(gym.Wrapper):
 
     def __init__(self, env, r_model):
@@ -157,3 +257,58 @@ class Reward_wrapper(gym.Wrapper):
     def step(self, action):
         observation, reward, done, info = self.env.step(action)
         return observation, self.r_model(observation), done, info
+
+
+
+from stable_baselines.bench import Monitor
+from stable_baselines.common.vec_env import SubprocVecEnv
+class RetargetableMonitor(Monitor):
+    """
+    Monitor whose log file can be switched while the env keeps running,
+    filename None stops the logging
+    """
+
+    def __init__(self, env, filename=None):
+        super(RetargetableMonitor, self).__init__(env, None)
+        self.retarget(filename)
+
+    def retarget(self, filename):
+        if self.file_handler is not None:
+            self.file_handler.close()
+            self.file_handler = None
+            self.logger = None
+        if filename is None:
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.file_handler = open(filename, "wt")
+        self.file_handler.write('#%s\n' % json.dumps({"t_start": self.t_start, 'env_id': self.env.spec and self.env.spec.id}))
+        self.logger = csv.DictWriter(self.file_handler, fieldnames=('r', 'l', 't'))
+        self.logger.writeheader()
+        self.file_handler.flush()
+
+
+class EnvPool(object):
+    """
+    Long-lived SubprocVecEnv, shared by annotation collection, policy training
+    and evaluation instead of spawning new workers for each of them.
+    The workers are retargeted (episode length, monitor files) between the phases
+    """
+
+    def __init__(self, env_fn, n_envs=None):
+        #This is probably optimal for speed on Atari and don't make difference on Procgen
+        self.n_envs = n_envs or multiprocessing.cpu_count()
+        self.venv = SubprocVecEnv([lambda: RetargetableMonitor(env_fn()) for _ in range(self.n_envs)])
+        self.default_max_steps = self.venv.get_attr('max_steps')[0]
+
+    def set_max_steps(self, max_steps=None):
+        '''episode length of every worker, back to the default with None'''
+        self.venv.env_method('set_max_steps', max_steps or self.default_max_steps)
+
+    def set_monitor_dir(self, monitor_dir):
+        '''worker i logs its episodes to monitor_dir/i.monitor.csv, None stops the logging'''
+        for i in range(self.n_envs):
+            filename = None if monitor_dir is None else os.path.join(monitor_dir, f'{i}.monitor.csv')
+            self.venv.env_method('retarget', filename, indices=[i])
+
+    def close(self):
+        self.venv.close()
@@ -3,6 +3,7 @@ import torch.optim as optim
 import torch
 
 from stable_baselines import PPO2
+from stable_baselines.ppo2 import ppo2
 from stable_baselines.common.policies import MlpPolicy, CnnPolicy
 from stable_baselines.common import make_vec_env
 from stable_baselines.common.evaluation import evaluate_policy
@@ -16,9 +17,10 @@ import numpy as np
 import random
 import argparse, pickle
 import multiprocessing
+from queue import Empty
 
 import tensorflow as tf
-import os, time, datetime, sys
+import os, time, datetime, sys, atexit
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -33,34 +35,131 @@ class AnnotationBuffer(object):
     label : float in range [0,1] corresponding to which clip is preferred
     label can also be 0.5 meaning clips are equal, or e.g. 0.95 corresponding 
     to noize in labeling 
+
+    The clips are stored in one uint8 array (allocated on the first add, once
+    the clip shape is known) that doubles when full, up to max_size pairs,
+    the labels in a float vector. Once full, new pairs replace the oldest ones ('fifo') or
+    random ones with probability max_size / pairs added so far ('reservoir')
     """
 
-    def __init__(self, max_size = 1000):
+    def __init__(self, max_size = 1000, eviction = 'fifo'):
+        assert eviction in ('fifo', 'reservoir')
+        self.max_size = max_size
+        self.eviction = eviction
+        self.clips = None
+        self.labels = np.zeros(max_size, dtype = np.float32)
+        self.is_val = np.zeros(max_size, dtype = bool)
         self.current_size = 0
-        self.train_data = []
-        self.val_data = []
+        self.num_added = 0
+        self.train_idx = np.zeros(0, dtype = np.int64)
+        self.val_idx = np.zeros(0, dtype = np.int64)
+
+    def _reserve(self, n, clip_shape):
+        '''makes room for n pairs, growing the clip array geometrically up to max_size'''
+        capacity = 0 if self.clips is None else len(self.clips)
+        if n <= capacity:
+            return
+        clips = np.zeros((min(self.max_size, max(n, 2 * capacity)), 2, *clip_shape), dtype = np.uint8)
+        if capacity:
+            clips[:self.current_size] = self.clips[:self.current_size]
+        self.clips = clips
+
+    def _slots(self, n):
+        '''buffer positions of n new pairs, -1 for the ones the reservoir drops'''
+        slots = np.empty(n, dtype = np.int64)
+        n_free = min(n, self.max_size - self.current_size)
+        slots[:n_free] = np.arange(self.current_size, self.current_size + n_free)
+        self.current_size += n_free
+        added = self.num_added + np.arange(n_free, n)
+        if self.eviction == 'fifo':
+            slots[n_free:] = added % self.max_size
+        else:
+            for k, num_added in zip(range(n_free, n), added):
+                j = random.randint(0, num_added)
+                slots[k] = j if j < self.max_size else -1
+        self.num_added += n
+        return slots
 
     def add(self, data):
         '''
         1/e of data goes to the validatation set
         the rest goes to the training set
-        '''
-        new_val_data , new_train_data = np.split(data, [int(len(data) / np.exp(1))])
-        self.val_data.extend(new_val_data)
-        self.train_data.extend(new_train_data)
-        
-        self.current_size += len(data)
 
+        data is ClipPairs, or a list of (clip0, clip1, label)
+        '''
+        data = self._as_clip_pairs(data)
+        n = len(data.pairs)
+        self._reserve(min(self.max_size, self.current_size + n), data.clips.shape[1:])
+        is_val = np.arange(n) < int(n / np.exp(1))
+
+        slots = self._slots(n)
+        # the last of the new pairs given the same position is the one kept
+        _, last = np.unique(slots[::-1], return_index = True)
+        keep = n - 1 - last
+        keep = keep[slots[keep] >= 0]
+        slots = slots[keep]
+        # one copy from the clip block, both clips of every pair at once
+        self.clips[slots] = data.clips[data.pairs[keep]]
+        self.labels[slots] = data.labels[keep]
+        self.is_val[slots] = is_val[keep]
+
+        self.train_idx = np.flatnonzero(~self.is_val[:self.current_size])
+        self.val_idx = np.flatnonzero(self.is_val[:self.current_size])
+
+    @staticmethod
+    def _as_clip_pairs(data):
+        '''ClipPairs as they are, lists of (clip0, clip1, label) tuples stacked into one'''
+        if isinstance(data, ClipPairs):
+            return data
+        clips = np.stack([clip for clip0, clip1, _ in data for clip in (clip0, clip1)])
+        pairs = np.arange(len(clips)).reshape(-1, 2)
+        labels = np.array([label for _, _, label in data], dtype = np.float32)
+        return ClipPairs(clips, pairs, labels)
+
+    def _pair(self, i):
+        return self.clips[i, 0], self.clips[i, 1], self.labels[i]
+
+    def _pairs(self, idx):
+        '''clips0, clips1, labels of the (sorted) positions idx'''
+        return self.clips[idx, 0], self.clips[idx, 1], self.labels[idx]
+
+    def _sample(self, idx, n):
+        # O(n): picks positions without permuting the whole index
+        idx = np.sort(idx[random.sample(range(len(idx)), n)])
+        return self._pairs(idx)
 
     def sample_batch(self, n):
-        return random.sample(self.train_data, n)
+        '''returns arrays (clips0, clips1, labels) of n training pairs'''
+        return self._sample(self.train_idx, n)
 
     def sample_val_batch(self, n):
-        return random.sample(self.val_data, n)
+        return self._sample(self.val_idx, n)
 
     def val_iter(self):
         'iterator over validation set'
-        return iter(self.val_data)
+        return (self._pair(i) for i in self.val_idx)
+
+    def val_batches(self, batch_size, max_pairs = None):
+        '''
+        iterator over batches (clips0, clips1, labels) of the validation set, or of
+        a subsample of max_pairs of it, stratified by label (each label value keeps its share)
+        '''
+        idx = self.val_idx
+        if max_pairs is not None and len(idx) > max_pairs:
+            labels = self.labels[idx]
+            strata = [idx[labels == value] for value in np.unique(labels)]
+            counts = [int(round(max_pairs * len(stratum) / len(idx))) for stratum in strata]
+            idx = np.concatenate([stratum[random.sample(range(len(stratum)), min(count, len(stratum)))]
+                                  for stratum, count in zip(strata, counts)])
+        return self._batches(idx, batch_size)
+
+    def all_batches(self, batch_size):
+        '''iterator over batches (clips0, clips1, labels) of all of the stored pairs'''
+        return self._batches(np.arange(self.current_size), batch_size)
+
+    def _batches(self, idx, batch_size):
+        idx = np.sort(idx)
+        return (self._pairs(idx[i:i + batch_size]) for i in range(0, len(idx), batch_size))
 
     @property
     def size(self):
@@ -69,16 +168,151 @@ class AnnotationBuffer(object):
 
     @property
     def loss_lb(self):
-        return - np.mean([label == 0.5 for (c1,c2,label) in self.train_data]) * np.log(0.5)
+        return - np.mean(self.labels[self.train_idx] == 0.5) * np.log(0.5)
 
     @property
     def val_loss_lb(self):
-        return - np.mean([label == 0.5 for (c1,c2,label) in self.val_data]) * np.log(0.5)
+        return - np.mean(self.labels[self.val_idx] == 0.5) * np.log(0.5)
 
     
 
     def get_all_pairs(self):
-        return np.concatenate((self.train_data, self.val_data))
+        '''iterator over all of the stored pairs, as views into the buffer'''
+        return (self._pair(i) for i in range(self.current_size))
+
+    def __getstate__(self):
+        # only the filled part of the clip array gets pickled
+        state = self.__dict__.copy()
+        if self.clips is not None:
+            state['clips'] = self.clips[:self.current_size]
+        return state
+
+    def __setstate__(self, state):
+        clips = state['clips']
+        self.__dict__.update(state)
+        if clips is not None:
+            self.clips = None
+            self._reserve(self.current_size, clips.shape[2:])
+            self.clips[:self.current_size] = clips
+
+
+class DiskAnnotationBuffer(AnnotationBuffer):
+    """AnnotationBuffer with the clips in memory-mapped shard files
+
+    Pairs are appended to shard files of shard_size pairs in shard_dir
+    (shard_<k>.npy), only the labels, the val mask and the open memmaps are
+    kept in RAM. Sampled positions are sorted and read shard by shard.
+    With max_size set, the oldest pairs are evicted once it is exceeded (fifo),
+    and a shard file is deleted once none of its pairs are left.
+    Pickling stores only the index, the shards stay where they are
+    """
+
+    def __init__(self, shard_dir, shard_size = 1000, max_size = None):
+        # no preallocation: the labels and the val mask start empty and grow with the pairs
+        super().__init__(max_size = 0, eviction = 'fifo')
+        self.max_size = max_size
+        self.shard_dir = shard_dir
+        os.makedirs(shard_dir, exist_ok = True)
+        self.shard_size = shard_size
+        self.clip_shape = None
+        self.shards = {}
+        # global id of the pair at position 0, pair ids map to shard files and offsets
+        self.first_id = 0
+
+    def _shard_path(self, k):
+        return os.path.join(self.shard_dir, f'shard_{k:06d}.npy')
+
+    def _shard(self, k, create = False):
+        '''
+        open memmap of shard k. Only add creates shard files, a missing one
+        on the read path means the shards were moved or deleted
+        '''
+        if k not in self.shards:
+            path = self._shard_path(k)
+            if os.path.exists(path):
+                self.shards[k] = np.load(path, mmap_mode = 'r+')
+            elif create:
+                self.shards[k] = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.uint8,
+                                                           shape = (self.shard_size, 2, *self.clip_shape))
+            else:
+                raise FileNotFoundError(f'Annotation shard {path} is missing')
+        return self.shards[k]
+
+    def add(self, data):
+        '''
+        1/e of data goes to the validatation set
+        the rest goes to the training set
+        '''
+        data = self._as_clip_pairs(data)
+        n = len(data.pairs)
+        if self.clip_shape is None:
+            self.clip_shape = data.clips.shape[1:]
+        is_val = np.arange(n) < int(n / np.exp(1))
+
+        # one copy per shard the new pairs fall into
+        ids = self.first_id + self.current_size + np.arange(n)
+        shards, offsets = np.divmod(ids, self.shard_size)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            self._shard(shard, create = True)[offsets[mask]] = data.clips[data.pairs[mask]]
+        self.current_size += n
+        self.num_added += n
+        self.labels = np.concatenate((self.labels, data.labels)).astype(np.float32)
+        self.is_val = np.concatenate((self.is_val, is_val))
+
+        if self.max_size is not None and self.current_size > self.max_size:
+            self._drop_oldest(self.current_size - self.max_size)
+
+        self.train_idx = np.flatnonzero(~self.is_val)
+        self.val_idx = np.flatnonzero(self.is_val)
+
+    def _drop_oldest(self, n):
+        '''evicts the n oldest pairs, deleting the shard files none of the remaining pairs are in'''
+        first_shard = self.first_id // self.shard_size
+        self.first_id += n
+        self.current_size -= n
+        self.labels = self.labels[n:]
+        self.is_val = self.is_val[n:]
+        for k in range(first_shard, self.first_id // self.shard_size):
+            self.shards.pop(k, None)
+            path = self._shard_path(k)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _pair(self, i):
+        shard, offset = divmod(self.first_id + i, self.shard_size)
+        clips = self._shard(shard)[offset]
+        return clips[0], clips[1], self.labels[i]
+
+    def _pairs(self, idx):
+        clips = np.empty((len(idx), 2, *self.clip_shape), dtype = np.uint8)
+        shards, offsets = np.divmod(self.first_id + idx, self.shard_size)
+        # one read per shard touched, in file order
+        for shard in np.unique(shards):
+            mask = shards == shard
+            clips[mask] = self._shard(shard)[offsets[mask]]
+        return clips[:, 0], clips[:, 1], self.labels[idx]
+
+    def __getstate__(self):
+        for shard in self.shards.values():
+            shard.flush()
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # the buffer may have evicted its oldest shards after this index was saved (e.g. when resuming
+        # from an earlier state), their pairs are dropped instead of failing on the first read
+        k = self.first_id // self.shard_size
+        while k * self.shard_size < self.first_id + self.current_size and not os.path.exists(self._shard_path(k)):
+            k += 1
+        n_missing = min(k * self.shard_size - self.first_id, self.current_size)
+        if n_missing > 0:
+            print(f'{n_missing} annotated pairs of evicted shards dropped from the buffer')
+            self._drop_oldest(n_missing)
+            self.train_idx = np.flatnonzero(~self.is_val)
+            self.val_idx = np.flatnonzero(self.is_val)
 
 class RewardNet(nn.Module):
     """Here we set up a callable reward model
@@ -159,13 +393,45 @@ class RewardNet(nn.Module):
 
         return torch.sum(self.model(clip))
 
-    def rew_fn(self, x):
+    def forward_pairs(self, clips0, clips1):
+        '''
+        predicts the returns of a batch of clip pairs with one pass
+        over all of their frames, clips are (n, clip_size, *obs_shape)
+        '''
+        n, clip_size = clips0.shape[:2]
+        frames = torch.cat((clips0, clips1)).reshape(2 * n * clip_size, *clips0.shape[2:])
+        if self.env_type == 'procgen':
+            frames = frames.permute(0,3,1,2)
+
+        returns = self._clips_forward(frames, clip_size).view(2, n, clip_size).sum(-1)
+        return returns[0], returns[1]
+
+    def _clips_forward(self, frames, clip_size):
+        '''
+        runs the model over the frames of consecutive clips. In training, the
+        BatchNorm layers normalize each clip_size chunk with its own statistics
+        (ghost batch norm), as when every clip went through forward on its own
+        '''
+        x = frames
+        for layer in self.model:
+            if isinstance(layer, nn.BatchNorm2d) and layer.training:
+                x = torch.cat([layer(chunk) for chunk in x.split(clip_size)])
+            else:
+                x = layer(x)
+        return x
+
+    def raw_rewards(self, x):
+        '''unnormalized rewards of a batch of frames, in eval mode'''
         self.model.eval()
         if self.env_type == 'procgen':
             x = x.permute(0,3,1,2)
         x = x / 255
 
-        rewards = torch.squeeze(self.model(x)).detach().cpu().numpy()
+        with torch.no_grad():
+            return torch.squeeze(self.model(x)).cpu().numpy()
+
+    def rew_fn(self, x):
+        rewards = self.raw_rewards(x)
 
         rewards = 0.05 * (rewards - self.mean) / self.std
 
@@ -175,54 +441,59 @@ class RewardNet(nn.Module):
     def save(self, path):
         torch.save(self.model, path)
 
-    def set_mean_std(self, pairs, device = 'cuda:0'):
-        rewards = []
-        for clip0, clip1 , label in pairs:
-            rewards.extend(self.rew_fn(torch.from_numpy(clip0).float().to(device)))
-            rewards.extend(self.rew_fn(torch.from_numpy(clip1).float().to(device)))
+    def set_mean_std(self, data_buffer, device = 'cuda:0', batch_size = 64):
+        '''reward mean and std over all frames of the buffer, in one streaming pass'''
+        stats = RunningStats()
+        for clips0, clips1, _ in data_buffer.all_batches(batch_size):
+            frames = np.concatenate((clips0, clips1)).reshape(-1, *clips0.shape[2:])
+            stats.update(self.raw_rewards(torch.from_numpy(frames).to(device).float()))
 
-        unnorm_rewards = self.std * np.array(rewards) / 0.05  + self.mean
-        self.mean, self.std = np.mean(unnorm_rewards), np.std(unnorm_rewards)
+        self.mean, self.std = stats.mean, stats.std
 
 
 
 def rm_loss_func(ret0, ret1, label, device = 'cuda:0'):
     '''custom loss function, to allow for float labels
-    unlike nn.CrossEntropyLoss'''
+    unlike nn.CrossEntropyLoss
+
+    works on single returns as well as on batches of them,
+    giving the loss of every pair'''
 
     #compute log(p1), log(p2) where p_i = exp(ret_i) / (exp(ret_1) + exp(ret_2))
-    lsm = nn.LogSoftmax(dim = 0)
-    log_preds = lsm(torch.stack((ret0, ret1)))
+    lsm = nn.LogSoftmax(dim = -1)
+    log_preds = lsm(torch.stack((ret0, ret1), dim = -1))
 
     #compute cross entropy given the label
-    target = torch.tensor([1-label, label]).to(device)
-    loss = - torch.sum(log_preds * target)
+    label = torch.as_tensor(label, dtype = torch.float32).to(device)
+    target = torch.stack((1-label, label), dim = -1)
+    loss = - torch.sum(log_preds * target, dim = -1)
 
 
 
     return loss
 
 @timeitt
-def calc_val_loss(reward_model, data_buffer, device):
+def calc_val_loss(reward_model, data_buffer, device, max_pairs = None, batch_size = 64):
+    '''
+    average loss over the validation set, or over a stratified subsample of max_pairs of it,
+    returned with the standard error of this pass (0 when the whole set is used)
+    '''
 
     reward_model.eval()
 
-    loss = 0
-    num_pairs = 0
-    for clip0, clip1 , label in data_buffer.val_iter():
-
-        ret0 = reward_model(torch.from_numpy(clip0).float().to(device))
-        ret1 = reward_model(torch.from_numpy(clip1).float().to(device))
-        loss += rm_loss_func(ret0, ret1, label, device).item()
-        num_pairs += 1
-
-    av_loss = loss / num_pairs
+    stats = RunningStats()
+    with torch.no_grad():
+        for clips0, clips1, labels in data_buffer.val_batches(batch_size, max_pairs):
+            ret0, ret1 = reward_model.forward_pairs(torch.from_numpy(clips0).to(device).float(),
+                                                    torch.from_numpy(clips1).to(device).float())
+            stats.update(rm_loss_func(ret0, ret1, labels, device).cpu().numpy())
 
-    return av_loss
+    return stats.mean, stats.sem(population_size = len(data_buffer.val_idx))
 
 
 @timeitt
-def train_reward(reward_model, data_buffer, num_samples, batch_size, device = 'cuda:0', obs_noize = 0.03):
+def train_reward(reward_model, data_buffer, num_samples, batch_size, device = 'cuda:0', obs_noize = 0.03, val_pairs = None,
+                 incremental_norm = False, val_loss_stats = None):
     '''
     Traines a given reward_model for num_batches from data_buffer
     Returns new reward_model
@@ -232,9 +503,22 @@ def train_reward(reward_model, data_buffer, num_samples, batch_size, device = 'c
         L2-loss on the output
         Output normalized to 0 mean and 0.05 variance across data_buffer
         (Ibarz et al. page 15)
+
+    With incremental_norm the normalization statistics come from the frames
+    of the last tenth of the training batches (after their update, in eval mode)
+    instead of a separate pass over the whole buffer
+
+    val_loss_stats (RunningStats) collects the validation losses of the successive
+    evaluations, the caller keeps it across calls. The L2 rule only acts when the
+    val loss is off by more than their standard deviation (how much the val loss
+    varies between evaluations); a new one spans only this call
         
     '''
     num_batches = int(num_samples / batch_size)
+    norm_stats = RunningStats()
+    norm_start = num_batches - max(1, num_batches // 10)
+    if val_loss_stats is None:
+        val_loss_stats = RunningStats()
 
     reward_model.to(device)
     weight_decay = reward_model.l2
@@ -242,61 +526,119 @@ def train_reward(reward_model, data_buffer, num_samples, batch_size, device = 'c
     
     losses = []
     for batch_i in range(num_batches):
-        annotations = data_buffer.sample_batch(batch_size)
-        loss = 0
+        clips0, clips1, labels = data_buffer.sample_batch(batch_size)
         optimizer.zero_grad()
         reward_model.train()
-        for clip0, clip1 , label in annotations:
-            
-            ret0 = reward_model(torch.from_numpy(clip0).float().to(device))
-            ret1 = reward_model(torch.from_numpy(clip1).float().to(device))
-            loss += rm_loss_func(ret0, ret1, label, device)
-        
-        loss = loss / batch_size
+        # one forward over all of the frames of the batch, copied to the device as uint8
+        clips0 = torch.from_numpy(clips0).to(device).float()
+        clips1 = torch.from_numpy(clips1).to(device).float()
+        ret0, ret1 = reward_model.forward_pairs(clips0, clips1)
+        loss = rm_loss_func(ret0, ret1, labels, device).mean()
         losses.append(loss.item())
 
         if batch_i % 100 == 0:
-            val_loss = calc_val_loss(reward_model, data_buffer, device) 
+            val_loss, val_se = calc_val_loss(reward_model, data_buffer, device, max_pairs = val_pairs)
+            val_loss_stats.update(val_loss)
+            val_sd = val_loss_stats.std
             av_loss = np.mean(losses[-100:])
-            #Adaptive L2 reg
-            if val_loss > 1.5 * (av_loss):
+            #Adaptive L2 reg, only changed when the val loss is off by more than its spread between evaluations
+            if val_loss - val_sd > 1.5 * (av_loss):
                 for g in optimizer.param_groups: 
                     g['weight_decay'] = g['weight_decay'] * 1.1
                     weight_decay = g['weight_decay']
-            elif val_loss < av_loss * 1.1:
+            elif val_loss + val_sd < av_loss * 1.1:
                  for g in optimizer.param_groups:
                     g['weight_decay'] = g['weight_decay'] / 1.1   
                     weight_decay = g['weight_decay']
 
-            print(f'batch : {batch_i}, loss : {av_loss:6.2f}, val loss: {val_loss:6.2f}, min_loss : {data_buffer.val_loss_lb:6.2f}, L2 : {weight_decay:8.6f}')
+            print(f'batch : {batch_i}, loss : {av_loss:6.2f}, val loss: {val_loss:6.2f} +- {val_se:4.2f} (sd between evals {val_sd:4.2f}), min_loss : {data_buffer.val_loss_lb:6.2f}, L2 : {weight_decay:8.6f}')
             
         loss.backward()
         optimizer.step()
 
+        if incremental_norm and batch_i >= norm_start:
+            norm_stats.update(reward_model.raw_rewards(torch.cat((clips0, clips1)).flatten(0, 1)))
+
     reward_model.l2 = weight_decay   
-    reward_model.set_mean_std(data_buffer.get_all_pairs())
+    if incremental_norm and norm_stats.n > 0:
+        reward_model.mean, reward_model.std = norm_stats.mean, norm_stats.std
+    else:
+        reward_model.set_mean_std(data_buffer, device)
 
     return reward_model, (av_loss, val_loss, weight_decay)
 
     
 
+class DeferredRewardRunner(ppo2.Runner):
+    '''
+    PPO2 runner for a Vec_reward_wrapper in deferred mode: after each rollout
+    the rewards of all of its steps come from one relabel() call, then the
+    advantages are computed as in ppo2.Runner
+    '''
+
+    def _run(self):
+        out = super()._run()
+        if out[0] is None:
+            # stopped by a callback
+            return out
+        obs, _, dones, actions, values, neglogpacs, states, ep_infos, _ = out
+
+        rewards = self.env.relabel()
+        # back from the flattened (n_envs * n_steps) layout to (n_steps, n_envs)
+        mb_values = values.reshape(self.n_envs, self.n_steps).T
+        mb_dones = dones.reshape(self.n_envs, self.n_steps).T
+        last_values = self.model.value(self.obs, self.states, self.dones)
+
+        mb_advs = np.zeros_like(rewards)
+        last_gae_lam = 0
+        for step in reversed(range(self.n_steps)):
+            if step == self.n_steps - 1:
+                nextnonterminal = 1.0 - self.dones
+                nextvalues = last_values
+            else:
+                nextnonterminal = 1.0 - mb_dones[step + 1]
+                nextvalues = mb_values[step + 1]
+            delta = rewards[step] + self.gamma * nextvalues * nextnonterminal - mb_values[step]
+            mb_advs[step] = last_gae_lam = delta + self.gamma * self.lam * nextnonterminal * last_gae_lam
+        mb_returns = mb_advs + mb_values
+
+        returns, true_reward = map(ppo2.swap_and_flatten, (mb_returns, rewards))
+        return obs, returns, dones, actions, values, neglogpacs, states, ep_infos, true_reward
+
+
+class ProxyRewardPPO2(PPO2):
+    '''
+    PPO2 that rolls out with a DeferredRewardRunner when its env is a
+    Vec_reward_wrapper in deferred mode, and with the usual runner otherwise
+    '''
+
+    def _make_runner(self):
+        if getattr(self.env, 'deferred', False):
+            return DeferredRewardRunner(env=self.env, model=self, n_steps=self.n_steps,
+                                        gamma=self.gamma, lam=self.lam)
+        return super()._make_runner()
+
+
 @timeitt
-def train_policy(venv_fn, reward_model, policy, num_steps, device):
+def train_policy(venv, reward_model, policy, num_steps, device, deferred_rewards = False):
     '''
-    Creates new environment by wrapping the env, with Vec_reward_wrapper given the reward_model.
+    Creates new environment by wrapping the venv, with Vec_reward_wrapper given the reward_model.
     Traines policy in the new envirionment for num_steps
+    With deferred_rewards the rewards of each rollout are computed in one batch at its end
     Returns retrained policy
     '''
 
     #creating the environment with reward predicted  from reward_model
     reward_model.to(device)
     proxy_reward_function = lambda x: reward_model.rew_fn(torch.from_numpy(x).float().to(device))
-    proxy_reward_venv = Vec_reward_wrapper(venv_fn(), proxy_reward_function)
+    proxy_reward_venv = Vec_reward_wrapper(venv, proxy_reward_function, deferred = deferred_rewards)
 
     # proxy_reward_function = lambda x: reward_model.rew_fn(torch.from_numpy(x[None,:]).float().to(device))
     # proxy_env_fn = lambda : Reward_wrapper(env_fn(), proxy_reward_function)
     # proxy_reward_venv = make_vec_env(proxy_env_fn, n_envs = 16, vec_env_cls = SubprocVecEnv)
 
+    # the runner is rebuilt for the new env, deferred rewards need a ProxyRewardPPO2 policy
+    assert not deferred_rewards or isinstance(policy, ProxyRewardPPO2)
     policy.set_env(proxy_reward_venv)
     policy.learn(num_steps)
 
@@ -306,54 +648,213 @@ def train_policy(venv_fn, reward_model, policy, num_steps, device):
 
 from collections import namedtuple
 Annotation = namedtuple('Annotation', ['clip0', 'clip1', 'label']) 
+# clips: (n_clips, clip_size, *obs_shape) uint8, pairs: (n_pairs, 2) indices into clips, labels: (n_pairs,)
+ClipPairs = namedtuple('ClipPairs', ['clips', 'pairs', 'labels'])
 
 @timeitt
-def collect_annotations(env_fn, policy, num_pairs, clip_size):
+def collect_annotations(env_fn, policy, num_pairs, clip_size, pool = None):
     '''Collects episodes using the provided policy, slices them to snippets of given length,
     selects pairs randomly and annotates 
-    Returns a list of named tuples (clip0, clip1, label), where label is float in [0,1]
+    Returns ClipPairs: the clips, index pairs into them and the labels, floats in [0,1]
 
+    Runs in the workers of pool (an EnvPool) if given, otherwise in a temporary one
     '''
-    #This is probably optimal for speed on Atari and don't make difference on Procgen
-    n_envs = multiprocessing.cpu_count()
+    own_pool = pool is None
+    if own_pool:
+        pool = EnvPool(env_fn)
+    n_envs = pool.n_envs
+    venv = pool.venv
 
-    venv = make_vec_env(env_fn, n_envs = n_envs, vec_env_cls = SubprocVecEnv) 
+    pool.set_monitor_dir(None)
+    pool.set_max_steps(int(clip_size * 2 * num_pairs / n_envs) + 10)
 
-    venv.set_attr('max_steps', int(clip_size * 2 * num_pairs / n_envs) + 10)
-    clip_pool = []
-    obs_stack = []
+    # clips are written straight into one block as the rollouts stream in, a round gives one clip per env
+    n_rounds = int(np.ceil(2 * num_pairs / n_envs))
     obs_b = venv.reset()
-    while len(clip_pool) < num_pairs * 2:
-        clip_returns = n_envs * [0]
-        for _ in range(clip_size):
+    clips = np.empty((n_rounds * n_envs, clip_size, *obs_b.shape[1:]), dtype = np.uint8)
+    clip_returns = np.zeros(n_rounds * n_envs)
+    for r in range(n_rounds):
+        envs_clips = slice(r * n_envs, (r + 1) * n_envs)
+        for t in range(clip_size):
             # _states are only useful when using LSTM policies
             action_b , _states = policy.predict(obs_b)
-            obs_stack.append(obs_b)
+            clips[envs_clips, t] = obs_b
 
             obs_b, r_b, dones, infos = venv.step(action_b)    
-            clip_returns += r_b
+            clip_returns[envs_clips] += r_b
 
-        obs_stack = np.array(obs_stack)
-        clip_pool.extend([dict( observations = obs_stack[:, i, :], sum_rews = clip_returns[i]) for i in range(n_envs)])
+    if own_pool:
+        pool.close()
+    else:
+        pool.set_max_steps(None)
 
-        obs_stack = []
+    return make_clip_pairs(clips, clip_returns, num_pairs)
 
-    clip_pairs = np.random.choice(clip_pool, (num_pairs, 2), replace = False)
-    data = []
-    for clip0, clip1 in clip_pairs:
 
-        if clip0['sum_rews'] > clip1['sum_rews']:
-            label = 0.0
-        elif clip0['sum_rews'] < clip1['sum_rews']:
-            label = 1.0 
-        elif clip0['sum_rews'] == clip1['sum_rews']:
-            # # skipping clips with same rewards for now
-            # continue
-            label = 0.5
+def make_clip_pairs(clips, clip_returns, num_pairs):
+    '''draws num_pairs pairs of distinct clips and labels them by their true returns'''
+    pairs = np.random.choice(len(clips), (num_pairs, 2), replace = False)
+    ret0, ret1 = clip_returns[pairs[:, 0]], clip_returns[pairs[:, 1]]
+    # equal returns get 0.5
+    labels = np.where(ret0 > ret1, 0.0, np.where(ret0 < ret1, 1.0, 0.5)).astype(np.float32)
 
-        data.append(Annotation(np.array(clip0['observations']), np.array(clip1['observations']), label))
+    return ClipPairs(clips, pairs, labels)
 
-    return data
+
+# what log_iter needs of the buffer, sent along with the snapshots of the async pipeline
+BufferInfo = namedtuple('BufferInfo', ['size', 'val_loss_lb'])
+
+def reward_learner(reward_model, data_buffer, args, device, queue, snapshot_path, run_dir):
+    '''
+    Learner process of the async pipeline. Adds the annotations coming through
+    queue to data_buffer and trains reward_model on it round after round, every
+    round's model is published to snapshot_path (replaced atomically, so that a
+    reader never sees a partial file). After max_learner_rounds rounds without
+    new annotations it waits for some.
+
+    Messages: ('annotations', i, [ClipPairs]), ('save', i) and ('stop',)
+    '''
+    stage_stats = StageStats(os.path.join(run_dir, 'learner_stats.csv'))
+    val_loss_stats = RunningStats()
+    version = 0
+    data_iter = -1
+    rounds_on_data = 0
+    stopping = False
+
+    while not stopping:
+        wait_start = time.time()
+        waiting = data_buffer.size == 0 or rounds_on_data >= args.max_learner_rounds
+        messages = []
+        try:
+            while True:
+                # blocks for the first message only when there is nothing to train on
+                messages.append(queue.get(block = waiting and not messages))
+        except Empty:
+            pass
+        if waiting:
+            stage_stats.log(data_iter, 'learner_wait', time.time() - wait_start)
+
+        for message in messages:
+            if message[0] == 'annotations':
+                _, data_iter, annotations = message
+                for a in annotations:
+                    data_buffer.add(a)
+                rounds_on_data = 0
+            elif message[0] == 'save':
+                save_buffer(run_dir, message[1], data_buffer)
+            elif message[0] == 'stop':
+                stopping = True
+        if stopping or data_buffer.size == 0 or rounds_on_data >= args.max_learner_rounds:
+            continue
+
+        start = time.time()
+        reward_model, rm_train_stats = train_reward(reward_model, data_buffer, args.pairs_per_iter, args.pairs_in_batch,
+                                                    device = device, val_pairs = args.val_pairs,
+                                                    incremental_norm = args.incremental_norm, val_loss_stats = val_loss_stats)
+        version += 1
+        rounds_on_data += 1
+        stage_stats.log(data_iter, 'reward', time.time() - start, args.pairs_per_iter)
+
+        snapshot = dict(version = version, data_iter = data_iter, reward_model = reward_model,
+                        rm_train_stats = rm_train_stats, buffer_info = BufferInfo(data_buffer.size, data_buffer.val_loss_lb))
+        with open(snapshot_path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f)
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+
+
+def wait_for_snapshot(snapshot_path, min_data_iter, workers, poll_interval = 1.0):
+    '''
+    latest reward model snapshot, once there is one trained on the annotations of iteration min_data_iter or later,
+    fails if one of the worker processes the annotations depend on exited
+    '''
+    while True:
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot['data_iter'] >= min_data_iter:
+                return snapshot
+        for worker in workers:
+            if not worker.is_alive():
+                raise RuntimeError(f'{worker.name} exited with code {worker.exitcode}')
+        time.sleep(poll_interval)
+
+
+def make_env_fn(args):
+    '''constructor of the envs of the run'''
+    if args.env_type == 'procgen':
+        return lambda: Gym_procgen_continuous(
+            env_name = args.env_name, 
+            distribution_mode = args.distribution_mode, 
+            num_levels = args.num_levels, 
+            start_level = args.start_level
+            )
+    elif args.env_type == 'atari':
+        return lambda: Atari_continuous(args.env_name)
+
+
+def evaluate(policy, reward_model, eval_venv, proxy_eval_base_env, video_dir, i, device):
+    '''true (recorded to video_dir) and proxy return of an episode of the policy'''
+    eval_env = VecVideoRecorder(eval_venv, video_dir ,
+                   record_video_trigger=lambda x: x == 0, video_length=10000,
+                   name_prefix="on_iter_{}".format(i))
+
+    proxy_reward_function = lambda x: reward_model.rew_fn(torch.from_numpy(x)[None,:].float().to(device))
+    proxy_eval_env = Reward_wrapper(proxy_eval_base_env, proxy_reward_function)
+
+    true_performance, _ = evaluate_policy(policy, eval_env, n_eval_episodes=1)
+    eval_env.close_video_recorder()
+    proxy_performance, _ = evaluate_policy(policy, proxy_eval_env, n_eval_episodes=1)
+
+    print(f'True policy preformance = {true_performance}') 
+    print(f'Proxy policy preformance = {proxy_performance}') 
+
+    return true_performance, proxy_performance
+
+
+def actor(args, device, queue, learner_queue, run_dir, video_dir):
+    '''
+    Actor process of the async pipeline, running while the main process trains the
+    next policy. For every saved iteration i it loads the policy, collects num_pairs
+    annotations for iteration i+1 with its own envs and sends them to the learner,
+    then evaluates the policy with the reward model it was trained on and logs the iteration.
+
+    Messages: ('iter', i, num_pairs, rm_train_stats, buffer_info) and ('stop',)
+    '''
+    env_fn = make_env_fn(args)
+    pool = None
+    eval_venv = DummyVecEnv([env_fn])
+    proxy_eval_base_env = env_fn()
+    stage_stats = StageStats(os.path.join(run_dir, 'actor_stats.csv'))
+
+    while True:
+        message = queue.get()
+        if message[0] == 'stop':
+            break
+        _, i, num_pairs, rm_train_stats, buffer_info = message
+
+        load_dir = os.path.join(run_dir, 'saved_states', str(i))
+        policy = PPO2.load(load_path = os.path.join(load_dir, 'policy'), **args.ppo_kwargs)
+        with open(os.path.join(load_dir, 'rm.pth'), 'rb') as f:
+            reward_model = pickle.load(f)
+
+        if num_pairs > 0:
+            if pool is None:
+                pool = EnvPool(env_fn, n_envs = args.actor_envs)
+            start = time.time()
+            annotations = collect_annotations(env_fn, policy, num_pairs, args.clip_size, pool)
+            learner_queue.put(('annotations', i + 1, [annotations]))
+            stage_stats.log(i + 1, 'collect', time.time() - start, num_pairs)
+
+        start = time.time()
+        true_performance, proxy_performance = evaluate(policy, reward_model, eval_venv, proxy_eval_base_env,
+                                                       video_dir, i, device)
+        stage_stats.log(i, 'eval', time.time() - start, 2)
+        log_iter(run_dir, i, buffer_info, true_performance, proxy_performance, rm_train_stats)
+
+    if pool is not None:
+        pool.close()
+    # the learner may be gone already, its unread messages must not keep this process alive
+    learner_queue.cancel_join_thread()
 
 
 def main():
@@ -377,9 +878,31 @@ def main():
     parser.add_argument('--pairs_per_iter', type=int, default=10**5)
     parser.add_argument('--pairs_in_batch', type=int, default=16)
     parser.add_argument('--l2', type=float, default=0.0001)
+    parser.add_argument('--buffer_size', type=int, default=5000, help='max number of annotated pairs kept')
+    parser.add_argument('--buffer_eviction', type=str, default='fifo', choices=['fifo', 'reservoir'])
+    parser.add_argument('--incremental_norm', action='store_true',
+                        help='reward normalization from the last training batches instead of a pass over the buffer')
+    parser.add_argument('--val_pairs', type=int, default=None, help='validation pairs the loss is estimated on (all by default)')
+    parser.add_argument('--harvest_clips', action='store_true',
+                        help='take the annotation clips from the policy training rollouts instead of separate ones')
+    parser.add_argument('--deferred_rewards', action='store_true',
+                        help='compute the proxy rewards of each PPO rollout in one batch at its end')
+    parser.add_argument('--async_pipeline', action='store_true',
+                        help='train the reward model in a separate process, the policy uses its latest snapshot')
+    parser.add_argument('--max_staleness', type=int, default=1,
+                        help='with --async_pipeline, iterations the annotations of the snapshot used by the policy may be behind')
+    parser.add_argument('--max_learner_rounds', type=int, default=2,
+                        help='with --async_pipeline, reward training rounds on the same annotations before waiting for new ones')
+    parser.add_argument('--actor_envs', type=int, default=8,
+                        help='with --async_pipeline, envs of the process collecting the annotations')
+    parser.add_argument('--disk_buffer', action='store_true',
+                        help='keep the annotated clips in memory-mapped shard files, evicting whole oldest shards (fifo only)')
+    parser.add_argument('--shard_size', type=int, default=1000, help='pairs per shard file of the disk buffer')
 
 
     args = parser.parse_args()
+    if args.disk_buffer and args.buffer_eviction != 'fifo':
+        parser.error('--disk_buffer only supports --buffer_eviction fifo')
 
     args.ppo_kwargs = dict(verbose=1, n_steps=256, noptepochs=3, nminibatches = 8)
 
@@ -390,69 +913,139 @@ def main():
     run_dir, monitor_dir, video_dir = setup_logging(args)
 
     if args.resume_training:
-        reward_model, policy, data_buffer, i_num = load_state(run_dir)
+        reward_model, policy, data_buffer, i_num = load_state(run_dir, policy_cls = ProxyRewardPPO2)
         args = load_args(args)
 
     #initializing objects
-    if args.env_type == 'procgen':
-        env_fn = lambda: Gym_procgen_continuous(
-            env_name = args.env_name, 
-            distribution_mode = args.distribution_mode, 
-            num_levels = args.num_levels, 
-            start_level = args.start_level
-            )
-    elif args.env_type == 'atari':
-        env_fn = lambda: Atari_continuous(args.env_name)
+    env_fn = make_env_fn(args)
 
-    venv_fn  = lambda:  make_vec_env(env_fn, monitor_dir = monitor_dir, n_envs = multiprocessing.cpu_count(), vec_env_cls = SubprocVecEnv)
+    # one set of env workers for the whole run: annotation collection and policy training share them,
+    # the evaluation envs are kept between the iterations as well
+    pool = EnvPool(env_fn)
+    tap = ClipTap(pool.venv, args.clip_size) if args.harvest_clips else None
+    if not args.async_pipeline:
+        eval_venv = DummyVecEnv([env_fn])
+        proxy_eval_base_env = env_fn()
 
 
     #in case this is a fresh run 
     if not args.resume_training:
         i_num = 0
-        policy = PPO2(ImpalaPolicy, venv_fn(), **args.ppo_kwargs)
+        policy = ProxyRewardPPO2(ImpalaPolicy, pool.venv, **args.ppo_kwargs)
         reward_model = RewardNet(l2= args.l2, env_type = args.env_type)
-        data_buffer = AnnotationBuffer()
+        if args.disk_buffer:
+            data_buffer = DiskAnnotationBuffer(os.path.join(run_dir, 'annotation_shards'),
+                                               shard_size = args.shard_size, max_size = args.buffer_size)
+        else:
+            data_buffer = AnnotationBuffer(max_size = args.buffer_size, eviction = args.buffer_eviction)
         store_args(args, run_dir)   
 
-
-
-    for i in range(i_num, args.num_iters + i_num):
+    stage_stats = StageStats(os.path.join(run_dir, 'pipeline_stats.csv'))
+    # validation losses of the reward model evaluations over the whole run, for the adaptive L2
+    val_loss_stats = RunningStats()
+    last_iter = args.num_iters + i_num - 1
+    learner = None
+    if args.async_pipeline:
+        # the reward model is trained in its own process, on the buffer, while the main process trains
+        # the policy and the actor process collects the annotations and evaluates the last policy
+        ctx = multiprocessing.get_context('spawn')
+        learner_queue = ctx.Queue()
+        # when the run fails, exiting must not wait for the learner (a daemon) to read its messages
+        learner_queue.cancel_join_thread()
+        actor_queue = ctx.Queue()
+        snapshot_path = os.path.join(run_dir, 'rm_snapshot.pkl')
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        learner = ctx.Process(target = reward_learner, name = 'reward learner',
+                              args = (reward_model, data_buffer, args, device, learner_queue, snapshot_path, run_dir),
+                              daemon = True)
+        learner.start()
+        # not a daemon, it has env worker processes of its own
+        actor_proc = ctx.Process(target = actor, name = 'actor',
+                                 args = (args, device, actor_queue, learner_queue, run_dir, video_dir))
+        actor_proc.start()
+        # so that it also stops when the main process fails, before the exit waits for it
+        atexit.register(actor_queue.put, ('stop',))
+        # the learner has its own copy
+        data_buffer = None
+
+        # the annotations of the first iteration, the later ones come from the actor (or the tap)
+        start = time.time()
+        num_pairs = int(args.init_buffer_size /(i_num+1))
+        learner_queue.put(('annotations', i_num, [collect_annotations(env_fn, policy, num_pairs, args.clip_size, pool)]))
+        stage_stats.log(i_num, 'collect', time.time() - start, num_pairs)
+
+
+    for i in range(i_num, last_iter + 1):
         print(f'================== iter : {i} ====================')
 
         num_pairs = int(args.init_buffer_size /(i+1))
-
-        prev_size = data_buffer.size     
-        while data_buffer.size - prev_size < num_pairs:
-            annotations = collect_annotations(env_fn, policy, num_pairs, args.clip_size)
-            data_buffer.add(annotations)   
-
-        print(f'Buffer size = {data_buffer.size}')
-        
-        reward_model, rm_train_stats = train_reward(reward_model, data_buffer, args.pairs_per_iter, args.pairs_in_batch) 
-        policy = train_policy(venv_fn, reward_model, policy, args.steps_per_iter, device)
-
-
-        eval_env = VecVideoRecorder(DummyVecEnv([env_fn]), video_dir ,
-                       record_video_trigger=lambda x: x == 0, video_length=10000,
-                       name_prefix="on_iter_{}".format(i))
-
-        proxy_reward_function = lambda x: reward_model.rew_fn(torch.from_numpy(x)[None,:].float().to(device))
-        proxy_eval_env = Reward_wrapper(env_fn(), proxy_reward_function)
-
-        true_performance, _ = evaluate_policy(policy, eval_env, n_eval_episodes=1)
-        proxy_performance, _ = evaluate_policy(policy, proxy_eval_env, n_eval_episodes=1)
-
-        print(f'True policy preformance = {true_performance}') 
-        print(f'Proxy policy preformance = {proxy_performance}') 
-
-
-        save_state(run_dir, i, reward_model, policy, data_buffer)
-        log_iter(run_dir, i, data_buffer, true_performance, proxy_performance, rm_train_stats)
+        next_pairs = int(args.init_buffer_size /(i+2)) if i < last_iter else 0
+
+        start = time.time()
+        if learner is None:
+            if tap is not None and tap.n_stored >= 2 * num_pairs:
+                # clips sampled during the last policy training, no separate rollouts needed
+                annotations = make_clip_pairs(*tap.harvest(), num_pairs)
+            else:
+                annotations = collect_annotations(env_fn, policy, num_pairs, args.clip_size, pool)
+            stage_stats.log(i, 'collect', time.time() - start, num_pairs)
+
+            start = time.time()
+            # the size stops growing once the buffer is full
+            data_buffer.add(annotations)
+            print(f'Buffer size = {data_buffer.size}')
+
+            reward_model, rm_train_stats = train_reward(reward_model, data_buffer, args.pairs_per_iter, args.pairs_in_batch,
+                                                        val_pairs = args.val_pairs, incremental_norm = args.incremental_norm,
+                                                        val_loss_stats = val_loss_stats)
+            buffer_info = data_buffer
+            stage_stats.log(i, 'reward', time.time() - start, args.pairs_per_iter)
+        else:
+            # the learner keeps training meanwhile, its latest model is used if it is recent enough
+            snapshot = wait_for_snapshot(snapshot_path, i - args.max_staleness, [learner, actor_proc])
+            reward_model, rm_train_stats, buffer_info = snapshot['reward_model'], snapshot['rm_train_stats'], snapshot['buffer_info']
+            print(f'Reward model snapshot {snapshot["version"]}, trained on the annotations up to iter {snapshot["data_iter"]}')
+            print(f'Buffer size = {buffer_info.size}')
+            stage_stats.log(i, 'snapshot_wait', time.time() - start, lag = i - snapshot['data_iter'])
+
+        start = time.time()
+        pool.set_monitor_dir(monitor_dir)
+        if tap is not None:
+            # enough clips for the pairs of the next iteration
+            tap.set_capacity(2 * next_pairs)
+        policy = train_policy(pool.venv if tap is None else tap, reward_model, policy, args.steps_per_iter, device,
+                              deferred_rewards = args.deferred_rewards)
+        pool.set_monitor_dir(None)
+        stage_stats.log(i, 'policy', time.time() - start, args.steps_per_iter)
+
+        if learner is None:
+            start = time.time()
+            true_performance, proxy_performance = evaluate(policy, reward_model, eval_venv, proxy_eval_base_env,
+                                                           video_dir, i, device)
+            stage_stats.log(i, 'eval', time.time() - start, 2)
+
+            save_state(run_dir, i, reward_model, policy, data_buffer)
+            log_iter(run_dir, i, buffer_info, true_performance, proxy_performance, rm_train_stats)
+        else:
+            actor_pairs = next_pairs
+            if tap is not None and next_pairs > 0 and tap.n_stored >= 2 * next_pairs:
+                learner_queue.put(('annotations', i + 1, [make_clip_pairs(*tap.harvest(), next_pairs)]))
+                actor_pairs = 0
+            # the actor loads the saved policy, the learner adds its buffer to the saved state
+            save_state(run_dir, i, reward_model, policy, None)
+            learner_queue.put(('save', i))
+            actor_queue.put(('iter', i, actor_pairs, rm_train_stats, buffer_info))
 
         os.rename(monitor_dir, monitor_dir + '_' + str(i))        
 
-
+    if learner is not None:
+        # the actor may still send the learner annotations, so it is stopped first
+        actor_queue.put(('stop',))
+        actor_proc.join()
+        learner_queue.put(('stop',))
+        learner.join()
+    pool.close()
 
 if __name__ == '__main__':
     main()
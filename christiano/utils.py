@@ -1,4 +1,5 @@
 import os, time, datetime
+import numpy as np
 import pickle
 import json, csv
 from stable_baselines import PPO2
@@ -25,20 +26,33 @@ def save_state(run_dir, i, reward_model, policy, data_buffer):
 
     policy_save_path = os.path.join(save_dir, 'policy')
     rm_save_path = os.path.join(save_dir, 'rm.pth')
-    data_buff_save_path = os.path.join(save_dir, 'data_buff.pth')
 
     with open(rm_save_path, 'wb') as f:
         pickle.dump(reward_model, f)
 
-    with open(data_buff_save_path, 'wb') as f:
-        pickle.dump(data_buffer, f)  
-
     policy.save(policy_save_path)
 
-def load_state(run_dir):
+    # written last, a state is complete once it has its buffer. With the async
+    # pipeline the buffer is in the learner process, which saves it itself
+    if data_buffer is not None:
+        save_buffer(run_dir, i, data_buffer)
+
+def save_buffer(run_dir, i, data_buffer):
+
+    save_dir =os.path.join(run_dir, "saved_states", str(i))
+    os.makedirs(save_dir, exist_ok=True)
+
+    data_buff_save_path = os.path.join(save_dir, 'data_buff.pth')
+    with open(data_buff_save_path + '.tmp', 'wb') as f:
+        pickle.dump(data_buffer, f)  
+    os.replace(data_buff_save_path + '.tmp', data_buff_save_path)
+
+def load_state(run_dir, policy_cls = PPO2):
 
     state_dir = os.path.join(run_dir, "saved_states")
-    i = max([int(f.name) for f in os.scandir(state_dir) if f.is_dir()])
+    # the last complete state, a crash can leave the newest one without its buffer
+    i = max([int(f.name) for f in os.scandir(state_dir)
+             if f.is_dir() and os.path.exists(os.path.join(f.path, 'data_buff.pth'))])
     load_dir =os.path.join(state_dir, str(i))
 
     policy_load_path = os.path.join(load_dir, 'policy')
@@ -52,7 +66,7 @@ def load_state(run_dir):
 
     reward_model = pickle.load(open(rm_load_path, 'rb'))
     data_buffer = pickle.load(open(data_buff_load_path, 'rb'))
-    policy = PPO2.load(load_path = policy_load_path, **args.ppo_kwargs)
+    policy = policy_cls.load(load_path = policy_load_path, **args.ppo_kwargs)
 
     return reward_model, policy, data_buffer, i+1
 
@@ -106,4 +120,62 @@ def log_iter(run_dir, i, data_buffer, true_return, proxy_return, rm_train_stats)
     train_loss, val_loss, l2 = rm_train_stats
     with open(info_path, 'a') as f: 
         rew_writer = csv.writer(f, delimiter = ',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        rew_writer.writerow([i, data_buffer.size, true_return, proxy_return, train_loss, val_loss, data_buffer.val_loss_lb, l2])
\ No newline at end of file
+        rew_writer.writerow([i, data_buffer.size, true_return, proxy_return, train_loss, val_loss, data_buffer.val_loss_lb, l2])
+
+class RunningStats:
+    '''running mean and variance (Welford), updated with batches of values'''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, values):
+        values = np.asarray(values, dtype = np.float64).ravel()
+        if len(values) == 0:
+            return
+        n = self.n + len(values)
+        delta = values.mean() - self.mean
+        # merging the batch statistics with the running ones (Chan et al.)
+        self.m2 += ((values - values.mean()) ** 2).sum() + delta ** 2 * self.n * len(values) / n
+        self.mean += delta * len(values) / n
+        self.n = n
+
+    @property
+    def var(self):
+        return self.m2 / self.n if self.n > 0 else 0.
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def sem(self, population_size = None):
+        '''standard error of the mean, with the finite population correction if the sample is from population_size values'''
+        if self.n < 2:
+            return 0.
+        se2 = self.m2 / (self.n - 1) / self.n
+        if population_size is not None:
+            se2 *= max(0., 1 - self.n / population_size)
+        return np.sqrt(se2)
+
+
+class StageStats:
+    '''
+    Throughput counters of the stages of the training loop, a row per stage run
+    appended to a csv file: (iter, stage, seconds, items, items_per_sec, lag).
+    Waiting stages have no items, lag is how many iterations behind the data used is
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                writer = csv.writer(f, delimiter = ',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(['iter', 'stage', 'seconds', 'items', 'items_per_sec', 'lag'])
+
+    def log(self, i, stage, seconds, items = None, lag = None):
+        items_per_sec = '' if items is None else round(items / max(seconds, 1e-9), 3)
+        with open(self.path, 'a') as f:
+            writer = csv.writer(f, delimiter = ',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow([i, stage, round(seconds, 3), '' if items is None else items, items_per_sec,
+                             '' if lag is None else lag])
@@ -69,10 +69,34 @@ def ProxyRewardWrapper_test():
     print('Success! : Replaced with zero reward')
 
 
+def deferred_relabel_test():
+    from env_wrapper import Vec_reward_wrapper
+    env = make_vec_env(lambda: Gym_procgen_continuous(env_name = 'fruitbot'), n_envs=4)
+
+    # squeezed like RewardNet.raw_rewards, so a batch of one frame gives a 0-d array
+    reward_model = lambda x: np.squeeze(x.reshape(len(x), -1).mean(axis = 1, keepdims = True))
+    # 11 steps of 4 envs: the last relabel batch holds a single frame
+    deferred_env = Vec_reward_wrapper(env, reward_model, deferred = True, batch_size = 43)
+    # per-step rewards of the very observations the deferred wrapper records
+    per_step_env = Vec_reward_wrapper(deferred_env, reward_model)
+
+    per_step_env.reset()
+    rews = []
+    for i in range(11):
+        ob, rew, done, info = per_step_env.step(4*[per_step_env.action_space.sample()])
+        rews.append(rew)
+    relabeled = deferred_env.relabel()
+
+    assert(relabeled.shape == (11, 4))
+    assert(np.allclose(relabeled, np.stack(rews)))
+    print('Success! : deferred rewards match the per-step ones')
+
+
 if __name__ == "__main__":
     
     no_death_test()
     ep_ends_test()
     baseline_test()
     ProxyRewardWrapper_test()
+    deferred_relabel_test()
     
\ No newline at end of file
@@ -0,0 +1,44 @@
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+# what each MPI rank of train_policy.py and each plotting script used to import to get the reward model,
+# against the runtime module they import now
+DEFAULT_MODULES = ['train_reward', 'helpers.utils', 'helpers.reward_net', 'helpers.rm_runtime', 'helpers.rm_registry']
+# entry points are timed up to their argument parsing (run with --help)
+DEFAULT_SCRIPTS = ['corrs.py', 'plot_correlations.py', 'visualize_demo.py', 'plot_reward_predictions.py',
+                   'compare_reward_models.py', 'rescore_reward_models.py', 'evict_reward_cache.py',
+                   'train_reward.py', 'train_policy.py']
+
+parser = argparse.ArgumentParser(description='Cold import time of the reward model modules and of the entry points, each in a fresh interpreter')
+parser.add_argument('--modules', nargs='*', default=DEFAULT_MODULES)
+parser.add_argument('--scripts', nargs='*', default=DEFAULT_SCRIPTS)
+parser.add_argument('--repeats', type=int, default=5)
+
+args = parser.parse_args()
+
+
+def run_time(cmd):
+    t = time.perf_counter()
+    subprocess.run([sys.executable, *cmd], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t
+
+
+def report(name, cmd, baseline):
+    try:
+        t = np.median([run_time(cmd) for _ in range(args.repeats)])
+    except subprocess.CalledProcessError:
+        print(f'{name:28s} failed to start')
+        return
+    print(f'{name:28s} {t - baseline:.3f}s (median of {args.repeats})')
+
+
+baseline = np.median([run_time(['-c', 'import sys']) for _ in range(args.repeats)])
+print(f'interpreter startup: {baseline:.3f}s, subtracted below')
+for module in args.modules:
+    report(module, ['-c', f'import {module}'], baseline)
+for script in args.scripts:
+    report(script, [script, '--help'], baseline)
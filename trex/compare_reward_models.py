@@ -0,0 +1,62 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+
+from helpers.utils import filter_csv_pandas, get_demo
+from helpers.rm_comparison import sample_frames, PredictionCache, score_models, pairwise_metrics
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+
+parser = argparse.ArgumentParser(description='Pairwise distances and correlations between reward models')
+parser.add_argument('--env_name', default='starpilot')
+parser.add_argument('--mode', default='easy')
+parser.add_argument('--sequential', type=int, default=0)
+
+parser.add_argument('--demo_csv', default='demos/demo_infos.csv')
+parser.add_argument('--rm_csv', default='reward_models/rm_infos.csv')
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY, help='registry of the stored reward models')
+parser.add_argument('--num_demos', type=int, default=100, help='number of test demos to sample the frames from')
+parser.add_argument('--num_frames', type=int, default=10000, help='number of frames all of the models are scored on')
+parser.add_argument('--seed', type=int, default=0, help='seed of the demo and frame sample')
+
+parser.add_argument('--cache_dir', default='rm_comparison_cache')
+parser.add_argument('--out_dir', default='rm_comparison')
+
+args = parser.parse_args()
+
+constraints = {
+    'env_name': args.env_name,
+    'mode': args.mode,
+    'sequential': args.sequential
+}
+
+rm_infos = filter_csv_pandas(pd.read_csv(args.rm_csv, dtype={'rm_id': str}), constraints)
+registry = RewardModelRegistry(args.rm_registry)
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# loaded through the runtime (architecture, output_abs) only when not cached
+models = {rm_id: registry.lookup(rm_id, device) for rm_id in rm_infos['rm_id']}
+print(f'{len(models)} reward models to compare')
+
+demo_infos = filter_csv_pandas(pd.read_csv(args.demo_csv), {'set_name': 'test', **constraints})
+demo_ids = demo_infos['demo_id'].sample(min(args.num_demos, len(demo_infos)), random_state=args.seed)
+demos = [get_demo(demo_id) for demo_id in sorted(demo_ids)]
+frames, sample_id = sample_frames(demos, args.num_frames, args.seed)
+print(f'{len(frames)} frames sampled from {len(demos)} demos, sample id {sample_id}')
+
+t = time.time()
+cache = PredictionCache(args.cache_dir, sample_id)
+preds = score_models(models, frames, cache)
+print(f'predictions ready in {time.time() - t:.1f}s')
+
+t = time.time()
+metrics = pairwise_metrics(preds)
+print(f'pairwise metrics computed in {time.time() - t:.2f}s')
+
+os.makedirs(args.out_dir, exist_ok=True)
+for name, matrix in metrics.items():
+    path = os.path.join(args.out_dir, f'{name}_{args.env_name}.csv')
+    pd.DataFrame(matrix, index=list(models), columns=list(models)).to_csv(path)
+    print(f'{name} saved to {path}')
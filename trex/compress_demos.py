@@ -0,0 +1,82 @@
+import os
+import glob
+import pickle
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from helpers.demo_compression import compress_demo, save_shared_table, load_compressed_demo, shared_table_name
+from helpers.hashing import frame_hash
+
+parser = argparse.ArgumentParser(description='Converts the .demo files of a folder into compressed .cdemo files')
+parser.add_argument('--demo_dir', type=str, default='demos/demo_files')
+parser.add_argument('--codec', type=str, default='zlib', choices=['zlib', 'lz4', 'zstd'])
+parser.add_argument('--chunk_size', type=int, default=64, help='number of frames compressed together')
+parser.add_argument('--no_delta', action='store_true', help='do not store frames as differences with the previous frame')
+parser.add_argument('--no_shared_table', action='store_true',
+                    help='do not store the frames repeated across demos in a shared table')
+parser.add_argument('--verify', action='store_true', help='check that the decoded observations match the originals')
+parser.add_argument('--remove_originals', action='store_true')
+
+args = parser.parse_args()
+
+demo_paths = sorted(glob.glob(os.path.join(args.demo_dir, '*.demo')))
+print(f'{len(demo_paths)} demos found in {args.demo_dir}')
+
+shared_hashes = None
+table_name = None
+if not args.no_shared_table:
+    # first pass: find the frames that appear in more than one demo
+    demo_counts = defaultdict(int)
+    for path in demo_paths:
+        demo = pickle.load(open(path, 'rb'))
+        for h in set(frame_hash(frame) for frame in demo['observations']):
+            demo_counts[h] += 1
+
+    shared_hashes = {}
+    shared_frames = []
+    for path in demo_paths:
+        demo = pickle.load(open(path, 'rb'))
+        for frame in demo['observations']:
+            h = frame_hash(frame)
+            if demo_counts[h] > 1 and h not in shared_hashes:
+                shared_hashes[h] = len(shared_frames)
+                shared_frames.append(frame)
+
+    print(f'{len(shared_frames)} frames are shared between demos')
+    if shared_frames:
+        # named after its content: the tables of earlier runs stay as they are for the cdemos using them
+        table_name = shared_table_name(shared_hashes)
+        table_path = os.path.join(args.demo_dir, table_name)
+        if os.path.exists(table_path):
+            print(f'Reusing the identical shared table {table_name}')
+        else:
+            save_shared_table(np.stack(shared_frames), table_path,
+                              codec=args.codec, chunk_size=args.chunk_size, delta=not args.no_delta)
+    else:
+        shared_hashes = None
+
+size_before, size_after = 0, 0
+for i, path in enumerate(demo_paths):
+    demo = pickle.load(open(path, 'rb'))
+    cdemo = compress_demo(demo, codec=args.codec, chunk_size=args.chunk_size,
+                          delta=not args.no_delta, shared_hashes=shared_hashes, shared_table=table_name)
+    cpath = path[:-len('.demo')] + '.cdemo'
+    with open(cpath, 'wb') as f:
+        pickle.dump(cdemo, f)
+
+    if args.verify:
+        assert np.array_equal(load_compressed_demo(cpath)['observations'], demo['observations']), path
+
+    size_before += os.path.getsize(path)
+    size_after += os.path.getsize(cpath)
+    if args.remove_originals:
+        os.remove(path)
+
+    if (i + 1) % 100 == 0 or i + 1 == len(demo_paths):
+        print(f'{i + 1}/{len(demo_paths)} demos compressed')
+
+if shared_hashes is not None:
+    size_after += os.path.getsize(table_path)
+print(f'{size_before / 2**20:.1f} MB -> {size_after / 2**20:.1f} MB ({size_before / max(size_after, 1):.1f}x smaller)')
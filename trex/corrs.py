@@ -1,10 +1,6 @@
-import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
 from helpers.utils import filter_csv_pandas
 
-from scipy.stats import pearsonr, spearmanr
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--env_name', default='fruitbot')
 parser.add_argument('--distribution_mode', default='easy')
@@ -19,6 +15,10 @@ parser.add_argument('--rm_csv', default='rm_infos_clean_no_l1.csv')
 
 args = parser.parse_args()
 
+# pandas and matplotlib load only after parsing, --help returns right away
+import pandas as pd
+import matplotlib.pyplot as plt
+
 
 # def get_baseline_corrs(demos):
 #     pearson_r, pearson_p = pearsonr(demos['length'], demos['returns'])
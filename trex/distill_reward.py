@@ -0,0 +1,170 @@
+import os
+import csv
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.optim as optim
+from scipy.stats import pearsonr
+
+from helpers.utils import filter_csv_pandas, get_demo
+from helpers.reward_net import StudentRewardNet
+from helpers.rm_runtime import RewardModelRuntime, FrameRewards
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+
+parser = argparse.ArgumentParser(description='Distills a trained reward model into a small student network')
+parser.add_argument('--teacher_id', type=str, required=True, help='id of the reward model to distill')
+parser.add_argument('--rm_id', type=str, default=None, help='id of the student, <teacher_id>_student by default')
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY)
+parser.add_argument('--env_name', default=None, help='taken from the registry entry of the teacher if not given')
+parser.add_argument('--mode', default=None)
+parser.add_argument('--sequential', type=int, default=None)
+
+parser.add_argument('--demo_csv', default='demos/demo_infos.csv')
+parser.add_argument('--num_train_demos', type=int, default=20, help='training demos whose frames the student is fit on')
+parser.add_argument('--num_test_demos', type=int, default=100, help='test demos the fidelity is measured on')
+parser.add_argument('--rollout_frames', type=int, default=20000,
+                    help='additional frames from random-action rollouts, off the demo distribution (needs procgen)')
+
+parser.add_argument('--num_epochs', type=int, default=20)
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--lr', type=float, default=1e-3)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--latency_repeats', type=int, default=100, help='timed forward passes of a batch of 64 frames')
+
+parser.add_argument('--save_dir', default='reward_models', help='where the student and distill_infos.csv get stored')
+
+
+def collect_rollout_frames(env_name, mode, sequential, n_frames, seed, num_envs=64):
+    '''frames of a uniformly random policy, to cover states the demos never visit'''
+    # imported here so that distilling on demo frames only does not require procgen
+    from procgen import ProcgenEnv
+    from baselines.common.vec_env import VecExtractDictObs
+
+    venv = ProcgenEnv(num_envs=num_envs, env_name=env_name, num_levels=0, start_level=seed,
+                      distribution_mode=mode, use_sequential_levels=sequential)
+    venv = VecExtractDictObs(venv, "rgb")
+    rng = np.random.default_rng(seed)
+    frames = [venv.reset()]
+    while len(frames) * num_envs < n_frames:
+        obs, _, _, _ = venv.step(rng.integers(venv.action_space.n, size=num_envs))
+        frames.append(obs)
+    venv.close()
+    return np.concatenate(frames)[:n_frames]
+
+
+def predict(model, frames, device, batch_size=1024):
+    with torch.no_grad():
+        return np.concatenate([model(torch.as_tensor(frames[i:i+batch_size], dtype=torch.float32).to(device)).cpu().numpy()
+                               for i in range(0, len(frames), batch_size)])
+
+
+def latency(model, device, repeats, batch_size=64):
+    '''median time of one forward pass of a batch, as in ProxyRewardWrapper'''
+    x = torch.rand((batch_size, 64, 64, 3), device=device) * 255
+    times = []
+    with torch.no_grad():
+        for i in range(repeats + 5):
+            t = time.perf_counter()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i >= 5:
+                times.append(time.perf_counter() - t)
+    return np.median(times)
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    registry = RewardModelRegistry(args.rm_registry)
+    teacher_entry = registry.lookup(args.teacher_id).entry
+    env_name = args.env_name or teacher_entry['env_name']
+    mode = args.mode or teacher_entry['mode']
+    sequential = args.sequential if args.sequential is not None else teacher_entry['sequential']
+    output_abs = bool(teacher_entry['output_abs'])
+    rm_id = args.rm_id or f'{args.teacher_id}_student'
+
+    teacher = RewardModelRuntime(teacher_entry['path'], output_abs=output_abs, device=device,
+                                 arch=teacher_entry['arch']).model
+    student_net = StudentRewardNet(output_abs=output_abs).to(device)
+    student = FrameRewards(student_net)
+
+    constraints = {'env_name': env_name, 'mode': mode, 'sequential': sequential}
+    demo_infos = pd.read_csv(args.demo_csv)
+    train_ids = filter_csv_pandas(demo_infos, {'set_name': 'train', **constraints})['demo_id']
+    test_ids = filter_csv_pandas(demo_infos, {'set_name': 'test', **constraints})['demo_id']
+    train_ids = train_ids.sample(min(args.num_train_demos, len(train_ids)), random_state=args.seed)
+    test_ids = test_ids.sample(min(args.num_test_demos, len(test_ids)), random_state=args.seed)
+
+    frames = [get_demo(demo_id)['observations'] for demo_id in train_ids]
+    if args.rollout_frames > 0:
+        frames.append(collect_rollout_frames(env_name, mode, sequential, args.rollout_frames, args.seed))
+    frames = np.concatenate(frames)
+    targets = predict(teacher, frames, device)
+    print(f'{len(frames)} training frames, teacher reward std {targets.std():.4f}')
+
+    # regression on the teacher's per-frame rewards, the loss is reported relative to their variance
+    targets_var = max(targets.var(), 1e-8)
+    optimizer = optim.Adam(student_net.parameters(), lr=args.lr)
+    for epoch in range(args.num_epochs):
+        perm = np.random.permutation(len(frames))
+        losses = []
+        for i in range(0, len(frames), args.batch_size):
+            batch = perm[i:i+args.batch_size]
+            x = torch.as_tensor(frames[batch], dtype=torch.float32).to(device)
+            y = torch.as_tensor(targets[batch]).to(device)
+            loss = torch.mean((student(x) - y) ** 2) / targets_var
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        print(f'epoch {epoch}: relative mse {np.mean(losses):.4f}')
+
+    # fidelity: correlation of the predicted returns of the test demos
+    teacher_returns, student_returns, true_returns = [], [], []
+    for demo_id in test_ids:
+        demo = get_demo(demo_id)
+        teacher_returns.append(predict(teacher, demo['observations'], device).sum())
+        student_returns.append(predict(student, demo['observations'], device).sum())
+        true_returns.append(demo['return'])
+    corr_teacher = pearsonr(student_returns, teacher_returns)[0]
+    corr_ground = pearsonr(student_returns, true_returns)[0]
+    teacher_corr_ground = pearsonr(teacher_returns, true_returns)[0]
+
+    teacher_latency = latency(teacher, device, args.latency_repeats)
+    student_latency = latency(student, device, args.latency_repeats)
+
+    print(f'return correlation with the teacher: {corr_teacher:.4f}')
+    print(f'return correlation with the ground truth: {corr_ground:.4f} (teacher {teacher_corr_ground:.4f})')
+    print(f'latency per batch of 64: {student_latency * 1000:.2f}ms (teacher {teacher_latency * 1000:.2f}ms)')
+
+    model_dir = os.path.join(args.save_dir, 'student_files')
+    os.makedirs(model_dir, exist_ok=True)
+    save_path = os.path.join(model_dir, rm_id + '.rm')
+    torch.save(student_net.state_dict(), save_path)
+
+    metadata = {'teacher_id': args.teacher_id, 'corr_teacher': float(corr_teacher), 'pearson': float(corr_ground),
+                'teacher_pearson': float(teacher_corr_ground), 'latency_ms': float(student_latency * 1000),
+                'teacher_latency_ms': float(teacher_latency * 1000), 'n_train_frames': len(frames)}
+    registry.register(rm_id, save_path, arch='student', output_abs=output_abs, env_name=env_name,
+                      mode=mode, sequential=sequential, num_dems=teacher_entry['num_dems'],
+                      seed=args.seed, metadata=metadata)
+    print(f'student saved to {save_path} and registered as {rm_id}')
+
+    info_path = os.path.join(args.save_dir, 'distill_infos.csv')
+    write_header = not os.path.exists(info_path)
+    with open(info_path, 'a') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        if write_header:
+            writer.writerow(['rm_id', *metadata])
+        writer.writerow([rm_id, *metadata.values()])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import csv
+import argparse
+
+import numpy as np
+from procgen import ProcgenEnv
+from baselines.common.vec_env import VecExtractDictObs
+
+from helpers.ProxyRewardWrapper import FrameRewardCache
+
+GAMES = ['bigfish', 'bossfight', 'caveflyer', 'chaser', 'climber', 'coinrun', 'dodgeball', 'fruitbot',
+         'heist', 'jumper', 'leaper', 'maze', 'miner', 'ninja', 'plunder', 'starpilot']
+
+parser = argparse.ArgumentParser(description='Hit rate of the frame reward cache of ProxyRewardWrapper on each procgen game')
+parser.add_argument('--env_names', nargs='+', default=GAMES)
+parser.add_argument('--distribution_mode', default='easy')
+parser.add_argument('--cache_sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+parser.add_argument('--num_envs', type=int, default=64)
+parser.add_argument('--num_steps', type=int, default=2000, help='steps of every env, taken by a uniformly random policy')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out_csv', default='LOGS/reward_cache_hit_rates.csv')
+
+args = parser.parse_args()
+
+# the hit rates do not depend on the rewards, so a constant model stands in for the reward net
+dummy_model = lambda obs: np.zeros(len(obs))
+
+os.makedirs(os.path.dirname(args.out_csv) or '.', exist_ok=True)
+with open(args.out_csv, 'w') as f:
+    writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(['env_name', 'mode', 'cache_size', 'frames', 'hit_rate'])
+
+    for env_name in args.env_names:
+        venv = ProcgenEnv(num_envs=args.num_envs, env_name=env_name, num_levels=0, start_level=args.seed,
+                          distribution_mode=args.distribution_mode)
+        venv = VecExtractDictObs(venv, "rgb")
+        rng = np.random.default_rng(args.seed)
+        caches = [FrameRewardCache(size) for size in args.cache_sizes]
+
+        obs = venv.reset()
+        for _ in range(args.num_steps):
+            obs, _, _, _ = venv.step(rng.integers(venv.action_space.n, size=args.num_envs))
+            for cache in caches:
+                cache(dummy_model, obs)
+        venv.close()
+
+        for cache in caches:
+            writer.writerow([env_name, args.distribution_mode, cache.max_size,
+                             cache.hits + cache.misses, cache.hit_rate])
+            print(f'{env_name:10s} cache size {cache.max_size:7d}: hit rate {cache.hit_rate:.3f}')
+        f.flush()
@@ -0,0 +1,23 @@
+import argparse
+
+from helpers.reward_cache import RewardCache
+
+parser = argparse.ArgumentParser(description='Evicts reward models from the predicted reward cache')
+parser.add_argument('--cache_dir', default='reward_cache')
+parser.add_argument('--max_age_days', type=float, default=None, help='evict models not written to for this long')
+parser.add_argument('--max_gb', type=float, default=None, help='evict the oldest models until the cache fits')
+parser.add_argument('--rm_id', nargs='+', default=[], help='evict these models')
+
+args = parser.parse_args()
+
+cache = RewardCache(args.cache_dir)
+for rm_id in args.rm_id:
+    cache.evict_model(rm_id)
+
+max_age = None if args.max_age_days is None else args.max_age_days * 24 * 3600
+max_bytes = None if args.max_gb is None else args.max_gb * 2**30
+evicted = cache.evict(max_age=max_age, max_bytes=max_bytes)
+
+print(f'{len(args.rm_id) + len(evicted)} models evicted')
+for rm_id, size, _ in cache.model_stats():
+    print(f'{rm_id:>12} {size / 2**20:8.1f} MB')
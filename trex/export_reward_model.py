@@ -0,0 +1,28 @@
+import os
+import argparse
+
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+from helpers.rm_runtime import export_torchscript
+
+parser = argparse.ArgumentParser(description='Exports stored reward models to TorchScript, loadable without the model code')
+parser.add_argument('--rm_id', nargs='+', required=True)
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY)
+parser.add_argument('--register', action='store_true',
+                    help='point the registry entries to the exported files (the training metadata is kept)')
+
+args = parser.parse_args()
+
+registry = RewardModelRegistry(args.rm_registry)
+for rm_id in args.rm_id:
+    entry = registry.entry(rm_id) or registry.lookup(rm_id).entry
+    if entry['arch'] == 'torchscript':
+        print(f'{rm_id} is already exported to {entry["path"]}')
+        continue
+    out_path = os.path.splitext(entry['path'])[0] + '.pt'
+    export_torchscript(entry['path'], out_path, output_abs=bool(entry['output_abs']), arch=entry['arch'])
+    print(f'{rm_id} exported to {out_path}')
+    if args.register:
+        registry.register(rm_id, out_path, arch='torchscript', output_abs=bool(entry['output_abs']),
+                          env_name=entry['env_name'], mode=entry['mode'], sequential=entry['sequential'],
+                          num_dems=entry['num_dems'], seed=entry['seed'], run_dir=entry['run_dir'],
+                          metadata=entry['metadata'])
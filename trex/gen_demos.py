@@ -12,6 +12,8 @@ from baselines.common.models import build_impala_cnn
 import argparse
 
 from helpers.trajectory_collection import ProcgenRunner
+from helpers.demo_compression import save_compressed_demo
+from helpers.demo_replay import save_replay_demo
 
 from baselines.ppo2 import ppo2
 
@@ -33,9 +35,13 @@ parser.add_argument('--sequential', type=int, default=0)
 parser.add_argument('--use_backgrounds', action='store_false')
 parser.add_argument('--log_dir', type=str, default='demos')
 parser.add_argument('--name', type=str, default=None, help="naming for this batch of generated trajectories")
+parser.add_argument('--compress', action='store_true', help="store demos in the compressed .cdemo format")
+parser.add_argument('--replay_format', action='store_true',
+                    help="store only the seed, env config, actions and rewards (.rdemo), observations are regenerated on load")
 
 
 args = parser.parse_args()
+assert not (args.compress and args.replay_format), 'choose only one of --compress and --replay_format'
 
 
 # load environments and generate some number of demonstration trajectories
@@ -89,7 +95,12 @@ with open(info_path, 'a') as csvfile:
         else:
             demo_prefix = '0'
         demo_id = '_'.join([demo_prefix, digits[0:3], digits[3:6], digits[6:9]])
-        file_name = demo_id + '.demo'
+        if args.compress:
+            file_name = demo_id + '.cdemo'
+        elif args.replay_format:
+            file_name = demo_id + '.rdemo'
+        else:
+            file_name = demo_id + '.demo'
 
         if args.sequential:
             seed = args.sequential
@@ -106,7 +117,12 @@ with open(info_path, 'a') as csvfile:
         demo['set_name'] = set_name
         demo['sequential'] = args.sequential
 
-        pickle.dump(demo, open(os.path.join(demo_dir, file_name), 'wb'))
+        if args.compress:
+            save_compressed_demo(demo, os.path.join(demo_dir, file_name))
+        elif args.replay_format:
+            save_replay_demo(demo, os.path.join(demo_dir, file_name), seed, args.use_backgrounds)
+        else:
+            pickle.dump(demo, open(os.path.join(demo_dir, file_name), 'wb'))
         writer.writerow(demo)
 
         num_generated += 1
@@ -1,5 +1,53 @@
+from collections import OrderedDict
+
+import numpy as np
 from baselines.common.vec_env import VecEnvWrapper
+from baselines import logger
+
+from helpers.hashing import frame_hash
+
+
+class FrameRewardCache:
+    """
+    Bounded LRU cache of per-frame rewards, keyed by the hash of the raw
+    observation. Procgen repeats a lot of frames (static screens, level starts,
+    respawns), so these never have to go through the reward model again
+    """
 
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.rewards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, r_model, obs):
+        keys = [frame_hash(o) for o in obs]
+        rews = np.empty(len(obs), dtype=np.float32)
+        # missing key -> indices of the frames with it (several envs can show the same frame)
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            r = self.rewards.get(key)
+            if r is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                self.rewards.move_to_end(key)
+                rews[i] = r
+        self.misses += len(missing)
+        self.hits += len(obs) - len(missing)
+
+        # only the distinct frames not seen recently go through the model, in one batch
+        if missing:
+            new_rews = np.asarray(r_model(obs[[idx[0] for idx in missing.values()]]), dtype=np.float32).reshape(-1)
+            for (key, idx), r in zip(missing.items(), new_rews):
+                rews[idx] = r
+                self.rewards[key] = r
+            while len(self.rewards) > self.max_size:
+                self.rewards.popitem(last=False)
+        return rews
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
 
 
 class ProxyRewardWrapper(VecEnvWrapper):
@@ -10,12 +58,21 @@ class ProxyRewardWrapper(VecEnvWrapper):
     r_model must be a callable function that takes batch of obervations
     and returns batch of rewards
 
+    with cache_size > 0 the rewards of the last cache_size distinct
+    frames are cached, the reward r_model gives a frame must then not depend
+    on the other frames of the batch (e.g. no BatchNorm in train mode).
+    The hit rate of every rollout_steps steps (one rollout) gets logged
+
     """
 
-    def __init__(self, venv, r_model):
+    def __init__(self, venv, r_model, cache_size=0, rollout_steps=256):
         VecEnvWrapper.__init__(self, venv)
         assert callable(r_model)
         self.r_model = r_model
+        self.cache = FrameRewardCache(cache_size) if cache_size > 0 else None
+        self.rollout_steps = rollout_steps
+        self.t = 0
+        self.rollout_start = (0, 0)
 
     def reset(self):
         obs = self.venv.reset()
@@ -23,6 +80,13 @@ class ProxyRewardWrapper(VecEnvWrapper):
 
     def step_wait(self):
         obs, rews, dones, infos = self.venv.step_wait()
-        return obs, self.r_model(obs), dones, infos
-
-    
+        if self.cache is None:
+            return obs, self.r_model(obs), dones, infos
+        rews = self.cache(self.r_model, obs)
+        self.t += 1
+        if self.t % self.rollout_steps == 0:
+            # hit rate of the rollout, shows up in the progress log of its update
+            hits, misses = self.cache.hits - self.rollout_start[0], self.cache.misses - self.rollout_start[1]
+            logger.logkv('reward_cache_hit_rate', hits / max(hits + misses, 1))
+            self.rollout_start = (self.cache.hits, self.cache.misses)
+        return obs, rews, dones, infos
@@ -48,4 +48,86 @@ def least_l2_affine(
     if scale:
         scale_param = coefs[scale_idx]
 
-    return shift_param, scale_param
\ No newline at end of file
+    return shift_param, scale_param
+
+
+def least_l2_affine_batch(
+    source: np.ndarray,
+    target: np.ndarray,
+    offsets: np.ndarray = None,
+    shift: bool = True,
+    scale: bool = True,
+):
+    """Finds the squared-error minimizing affine transforms of many (source, target) pairs.
+
+    Same solution and sign constraints (scale >= 0) as `least_l2_affine`, but computed
+    in closed form from per-pair sufficient statistics, for all of the pairs at once.
+
+    Args:
+        source: either a 2D array with one pair per row, or a 1D array with
+            all of the pairs concatenated, split by `offsets`.
+        target: array of the same shape as source, consisting of the targets to match.
+        offsets: for 1D inputs, the boundaries of the pairs: pair k is
+            source[offsets[k]:offsets[k + 1]], so offsets has one entry more than there are pairs.
+        shift: affine includes constant shift.
+        scale: affine includes rescale.
+
+    Returns:
+        (shifts, scales), arrays with one entry per pair, such that
+        (scale * reward + shift) has minimal squared-error from target for each pair.
+
+    Raises:
+        ValueError if the shapes of source and target differ, if offsets are missing
+        or invalid (not starting at 0, decreasing, or not ending at len(source))
+        for 1D inputs, or if neither shift or scale are True.
+    """
+    if source.shape != target.shape:
+        raise ValueError("source and target must have the same shape.")
+    if not (shift or scale):
+        raise ValueError("At least one of shift and scale must be True.")
+
+    if source.ndim == 2:
+        n_pairs, length = source.shape
+        groups = np.repeat(np.arange(n_pairs), length)
+        source, target = source.ravel(), target.ravel()
+    elif source.ndim == 1:
+        if offsets is None:
+            raise ValueError("offsets must be given for 1D inputs.")
+        offsets = np.asarray(offsets)
+        if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0 or offsets[-1] != len(source):
+            raise ValueError("offsets must start at 0 and end at len(source).")
+        lengths = np.diff(offsets)
+        if np.any(lengths < 0):
+            raise ValueError("offsets must be non-decreasing.")
+        n_pairs = len(lengths)
+        groups = np.repeat(np.arange(n_pairs), lengths)
+    else:
+        raise ValueError("source must be a matrix or a vector.")
+
+    source = source.astype(np.float64)
+    target = target.astype(np.float64)
+
+    counts = np.bincount(groups, minlength=n_pairs)
+    nonempty = counts > 0
+    mean_x = np.divide(np.bincount(groups, source, n_pairs), counts, out=np.zeros(n_pairs), where=nonempty)
+    mean_y = np.divide(np.bincount(groups, target, n_pairs), counts, out=np.zeros(n_pairs), where=nonempty)
+
+    if not scale:
+        return mean_y, np.ones(n_pairs)
+
+    if not shift:
+        sxx = np.bincount(groups, source * source, n_pairs)
+        sxy = np.bincount(groups, source * target, n_pairs)
+        scales = np.divide(sxy, sxx, out=np.zeros(n_pairs), where=sxx > 0)
+        return np.zeros(n_pairs), np.maximum(scales, 0.0)
+
+    # centering first keeps the statistics accurate for large offsets
+    xc = source - mean_x[groups]
+    yc = target - mean_y[groups]
+    var_x = np.bincount(groups, xc * xc, n_pairs)
+    cov_xy = np.bincount(groups, xc * yc, n_pairs)
+    # a negative unconstrained scale puts the constrained optimum at scale = 0
+    scales = np.maximum(np.divide(cov_xy, var_x, out=np.zeros(n_pairs), where=var_x > 0), 0.0)
+    shifts = mean_y - scales * mean_x
+
+    return shifts, scales
@@ -0,0 +1,194 @@
+import os
+import zlib
+import pickle
+import hashlib
+
+import numpy as np
+
+from helpers.hashing import frame_hash
+
+# optional faster codecs
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# name of the table before they were versioned, still read for the cdemos pointing at it
+SHARED_TABLE_NAME = 'shared_frames.ftab'
+
+# decoded shared frame tables, keyed by their absolute path
+_shared_tables = {}
+
+
+def get_codec(name):
+    '''returns (compress, decompress) functions of the codec'''
+    if name == 'zlib':
+        return (lambda b: zlib.compress(b, 6)), zlib.decompress
+    if name == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 codec requires the lz4 package')
+        return lz4.frame.compress, lz4.frame.decompress
+    if name == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd codec requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f'Unknown codec {name}')
+
+
+def shared_table_name(frame_hashes):
+    '''
+    file name of the shared table of the given (ordered) frame hashes. It changes with the content,
+    so a new table never replaces one that existing cdemos refer to
+    '''
+    h = hashlib.blake2b(digest_size=8)
+    for frame_h in frame_hashes:
+        h.update(frame_h)
+    return f'shared_frames_{h.hexdigest()}.ftab'
+
+
+def encode_chunks(frames, codec, chunk_size, delta):
+    '''
+    splits the frames into chunks and compresses each of them independently.
+    With delta, every frame except the first one of a chunk is stored as a
+    difference (mod 256) with the previous frame
+    '''
+    compress, _ = get_codec(codec)
+    chunks = []
+    for i in range(0, len(frames), chunk_size):
+        chunk = np.ascontiguousarray(frames[i:i+chunk_size])
+        if delta:
+            chunk = np.concatenate([chunk[:1], chunk[1:] - chunk[:-1]])
+        chunks.append(compress(chunk.tobytes()))
+    return chunks
+
+
+def decode_chunk(chunk, codec, delta, shape):
+    _, decompress = get_codec(codec)
+    frames = np.frombuffer(decompress(chunk), dtype=np.uint8).reshape(-1, *shape)
+    if delta:
+        # uint8 accumulation wraps around, undoing the mod 256 differences
+        frames = np.cumsum(frames, axis=0, dtype=np.uint8)
+    return frames
+
+
+def compress_demo(demo, codec='zlib', chunk_size=64, delta=True, shared_hashes=None, shared_table=None):
+    '''
+    Returns a copy of the demo with observations replaced by a compressed encoding.
+    Repeated frames within the demo are stored once, and frames found in
+    shared_hashes (dict of frame hash -> id in the shared table) are not stored at all,
+    shared_table is then the file name of that table (in the folder of the demo)
+    '''
+    if shared_hashes is not None and shared_table is None:
+        raise ValueError('shared_hashes requires the name of their shared_table')
+    observations = demo['observations']
+    shape = observations.shape[1:]
+
+    local_ids = {}
+    unique_frames = []
+    frame_index = np.empty(len(observations), dtype=np.int64)
+    for t, frame in enumerate(observations):
+        h = frame_hash(frame)
+        if shared_hashes is not None and h in shared_hashes:
+            # negative ids point into the shared table
+            frame_index[t] = -1 - shared_hashes[h]
+            continue
+        if h not in local_ids:
+            local_ids[h] = len(unique_frames)
+            unique_frames.append(frame)
+        frame_index[t] = local_ids[h]
+
+    if unique_frames:
+        unique_frames = np.stack(unique_frames)
+    else:
+        unique_frames = np.empty((0, *shape), dtype=np.uint8)
+
+    cdemo = {k: v for k, v in demo.items() if k != 'observations'}
+    cdemo['frames'] = {
+        'codec': codec,
+        'delta': delta,
+        'shape': shape,
+        'chunk_size': chunk_size,
+        'frame_index': frame_index,
+        'chunks': encode_chunks(unique_frames, codec, chunk_size, delta),
+        'shared_table': shared_table if shared_hashes is not None else None
+    }
+    return cdemo
+
+
+def load_shared_table(path):
+    path = os.path.abspath(path)
+    if path not in _shared_tables:
+        with open(path, 'rb') as f:
+            table = pickle.load(f)
+        chunks = [decode_chunk(c, table['codec'], table['delta'], table['shape'])
+                  for c in table['chunks']]
+        _shared_tables[path] = np.concatenate(chunks)
+    return _shared_tables[path]
+
+
+def save_shared_table(frames, path, codec='zlib', chunk_size=64, delta=True):
+    # cdemos may refer to an existing table, replacing it would silently corrupt them
+    if os.path.exists(path):
+        raise FileExistsError(f'Shared frame table {path} already exists')
+    table = {
+        'codec': codec,
+        'delta': delta,
+        'shape': frames.shape[1:],
+        'chunks': encode_chunks(frames, codec, chunk_size, delta)
+    }
+    with open(path, 'xb') as f:
+        pickle.dump(table, f)
+
+
+def decode_frames(cdemo, start=0, end=None, base_dir='.'):
+    '''
+    decodes observations [start:end] of a compressed demo,
+    only the chunks covering these frames get decompressed
+    '''
+    enc = cdemo['frames']
+    frame_index = enc['frame_index'][start:end]
+    out = np.empty((len(frame_index), *enc['shape']), dtype=np.uint8)
+
+    local = frame_index >= 0
+    if np.any(local):
+        chunk_size = enc['chunk_size']
+        ids = frame_index[local]
+        chunk_ids = ids // chunk_size
+        frames = np.empty((len(ids), *enc['shape']), dtype=np.uint8)
+        for c in np.unique(chunk_ids):
+            chunk = decode_chunk(enc['chunks'][c], enc['codec'], enc['delta'], enc['shape'])
+            in_chunk = chunk_ids == c
+            frames[in_chunk] = chunk[ids[in_chunk] - c * chunk_size]
+        out[local] = frames
+
+    if not np.all(local):
+        table = load_shared_table(os.path.join(base_dir, enc['shared_table']))
+        out[~local] = table[-1 - frame_index[~local]]
+
+    return out
+
+
+def save_compressed_demo(demo, path, **kwargs):
+    with open(path, 'wb') as f:
+        pickle.dump(compress_demo(demo, **kwargs), f)
+
+
+def load_compressed_demo(path):
+    '''loads a .cdemo file and returns the demo with decoded observations'''
+    with open(path, 'rb') as f:
+        cdemo = pickle.load(f)
+    demo = {k: v for k, v in cdemo.items() if k != 'frames'}
+    demo['observations'] = decode_frames(cdemo, base_dir=os.path.dirname(path))
+    return demo
+
+
+def load_snippet(path, start, end):
+    '''loads only observations [start:end] of a .cdemo file'''
+    with open(path, 'rb') as f:
+        cdemo = pickle.load(f)
+    return decode_frames(cdemo, start, end, base_dir=os.path.dirname(path))
@@ -0,0 +1,95 @@
+import pickle
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def seed_from_demo_id(demo_id, sequential=0):
+    '''
+    recovers the level seed gen_demos.py used for the demo,
+    for demos stored before the seed was recorded
+    '''
+    if sequential:
+        return sequential
+    prefix, *digits = demo_id.split('_')
+    seed = int(''.join(digits))
+    if prefix == '1':
+        seed += 1_000_000_000
+    return seed
+
+
+def make_replay_demo(demo, seed, use_backgrounds=True):
+    '''
+    returns the compact form of the demo: everything but the observations,
+    plus what is needed to regenerate them
+    '''
+    rdemo = {k: v for k, v in demo.items() if k != 'observations'}
+    rdemo['seed'] = seed
+    rdemo['use_backgrounds'] = use_backgrounds
+    rdemo['actions'] = np.asarray(demo['actions'])
+    return rdemo
+
+
+def replay(rdemo):
+    '''
+    regenerates the observations (and rewards) of the demo
+    by stepping a fresh procgen env through the stored actions
+    '''
+    # imported here so that reading the demo files does not require procgen
+    from procgen import ProcgenEnv
+    from baselines.common.vec_env import VecExtractDictObs
+
+    venv = ProcgenEnv(
+        num_envs=1,
+        env_name=rdemo['env_name'],
+        num_levels=1,
+        start_level=rdemo['seed'],
+        distribution_mode=rdemo['mode'],
+        use_sequential_levels=rdemo['sequential'],
+        use_backgrounds=rdemo['use_backgrounds']
+    )
+    venv = VecExtractDictObs(venv, "rgb")
+
+    obs = venv.reset()
+    actions = rdemo['actions']
+    observations = np.empty((len(actions), *obs.shape[1:]), dtype=obs.dtype)
+    rewards = np.empty(len(actions), dtype=np.float32)
+    # same order as in ProcgenRunner: the observation is recorded before the step
+    for t, action in enumerate(actions):
+        observations[t] = obs[0]
+        obs, rew, _, _ = venv.step(np.array([action]))
+        rewards[t] = rew[0]
+    venv.close()
+
+    return observations, rewards
+
+
+def replay_demo(rdemo):
+    '''returns the full demo, with observations regenerated'''
+    demo = {k: v for k, v in rdemo.items() if k not in ('seed', 'use_backgrounds')}
+    demo['observations'], _ = replay(rdemo)
+    return demo
+
+
+def verify_replay(rdemo):
+    '''checks that the replayed rewards and return match the stored ones'''
+    _, rewards = replay(rdemo)
+    return bool(np.allclose(rewards, rdemo['rewards']) and np.isclose(np.sum(rewards), rdemo['return']))
+
+
+def replay_demos(rdemos, num_workers=4):
+    '''replays several demos in parallel'''
+    with Pool(num_workers) as pool:
+        return pool.map(replay_demo, rdemos)
+
+
+def save_replay_demo(demo, path, seed, use_backgrounds=True):
+    with open(path, 'wb') as f:
+        pickle.dump(make_replay_demo(demo, seed, use_backgrounds), f)
+
+
+def load_replay_demo(path):
+    '''loads a .rdemo file and returns the demo with replayed observations'''
+    with open(path, 'rb') as f:
+        rdemo = pickle.load(f)
+    return replay_demo(rdemo)
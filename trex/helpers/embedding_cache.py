@@ -0,0 +1,60 @@
+import os
+import hashlib
+
+import numpy as np
+import torch
+
+
+def encoder_hash(encoder):
+    # short fingerprint of the encoder weights, used to key the embedding cache
+    h = hashlib.sha1()
+    for name, tensor in encoder.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def compute_embeddings(encoder, observations, device, batch_size=256):
+    '''runs the (frozen) encoder over all of the frames in batches'''
+    encoder.eval()
+    embs = []
+    with torch.no_grad():
+        for i in range(0, len(observations), batch_size):
+            x = torch.tensor(observations[i:i+batch_size], dtype=torch.float32).to(device)
+            # get into NCHW format
+            embs.append(encoder(x.permute(0, 3, 1, 2)).cpu().numpy())
+    return np.concatenate(embs).astype(np.float32)
+
+
+def get_demo_embeddings(demo, encoder, cache_dir, device, enc_hash=None):
+    '''
+    returns embeddings of every frame of the demo,
+    computing them only if they are not cached yet
+    '''
+    if enc_hash is None:
+        enc_hash = encoder_hash(encoder)
+    path = os.path.join(cache_dir, enc_hash, demo['demo_id'] + '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+
+    embs = compute_embeddings(encoder, demo['observations'], device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so that concurrent runs never read a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, embs)
+    os.replace(tmp_path, path)
+    return embs
+
+
+def embed_demos(demos, encoder, cache_dir, device):
+    '''
+    returns copies of the demos with observations replaced by frame embeddings
+    '''
+    enc_hash = encoder_hash(encoder)
+    embedded = []
+    for demo in demos:
+        demo = dict(demo)
+        demo['observations'] = get_demo_embeddings(demo, encoder, cache_dir, device, enc_hash)
+        embedded.append(demo)
+    return embedded
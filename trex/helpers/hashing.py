@@ -0,0 +1,6 @@
+import hashlib
+
+
+def frame_hash(frame):
+    # 16 byte digest of the raw observation, identifies repeated frames across demos and rollouts
+    return hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
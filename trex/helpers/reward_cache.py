@@ -0,0 +1,128 @@
+import os
+import time
+import fcntl
+import shutil
+import sqlite3
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class RewardCache:
+    """
+    Persistent cache of per-frame predicted rewards, keyed by (rm_id, demo_id).
+
+    The rewards of each model are appended as float32 to one data file
+    (cache_dir/<rm_id>.f32), an sqlite index keeps the offset and length of every
+    demo in it. Appends to a model file (and its eviction) take an exclusive file lock,
+    reads a shared one, so several processes can use the cache at the same time
+    """
+
+    def __init__(self, cache_dir='reward_cache'):
+        self.dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.sqlite')
+        with self._index() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS rewards ('
+                       'rm_id TEXT, demo_id TEXT, offset INTEGER, length INTEGER, '
+                       'created REAL, PRIMARY KEY (rm_id, demo_id))')
+
+    @contextmanager
+    def _index(self):
+        db = sqlite3.connect(self.index_path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _lock(self, rm_id, shared=False):
+        with open(os.path.join(self.dir, rm_id + '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _data_path(self, rm_id):
+        return os.path.join(self.dir, rm_id + '.f32')
+
+    def get(self, rm_id, demo_id):
+        '''returns the cached per-frame rewards, or None on a miss'''
+        # the index entry and the data file must not change in between (evict_model and a new put)
+        with self._lock(rm_id, shared=True):
+            return self._get(rm_id, demo_id)
+
+    def _get(self, rm_id, demo_id):
+        with self._index() as db:
+            row = db.execute('SELECT offset, length FROM rewards WHERE rm_id=? AND demo_id=?',
+                             (rm_id, demo_id)).fetchone()
+        if row is None:
+            return None
+        offset, length = row
+        return np.fromfile(self._data_path(rm_id), dtype=np.float32, count=length, offset=offset)
+
+    def put(self, rm_id, demo_id, rewards):
+        rewards = np.asarray(rewards, dtype=np.float32)
+        with self._lock(rm_id):
+            # another process may have stored the same demo in the meantime
+            if self._get(rm_id, demo_id) is not None:
+                return
+            with open(self._data_path(rm_id), 'ab') as f:
+                offset = f.tell()
+                f.write(rewards.tobytes())
+            with self._index() as db:
+                db.execute('INSERT OR REPLACE INTO rewards VALUES (?, ?, ?, ?, ?)',
+                           (rm_id, demo_id, offset, len(rewards), time.time()))
+
+    def get_or_compute(self, rm_id, demo, reward_fn):
+        '''
+        per-frame rewards of the demo, reward_fn(observations)
+        is only called on a cache miss
+        '''
+        rewards = self.get(rm_id, demo['demo_id'])
+        if rewards is None:
+            rewards = np.asarray(reward_fn(demo['observations']), dtype=np.float32)
+            self.put(rm_id, demo['demo_id'], rewards)
+        return rewards
+
+    def evict_model(self, rm_id):
+        with self._lock(rm_id):
+            with self._index() as db:
+                db.execute('DELETE FROM rewards WHERE rm_id=?', (rm_id,))
+            if os.path.exists(self._data_path(rm_id)):
+                os.remove(self._data_path(rm_id))
+
+    def model_stats(self):
+        '''list of (rm_id, size in bytes, time of the last write) of the cached models'''
+        with self._index() as db:
+            rows = db.execute('SELECT rm_id, SUM(length) * 4, MAX(created) FROM rewards GROUP BY rm_id').fetchall()
+        return rows
+
+    def evict(self, max_age=None, max_bytes=None):
+        '''
+        evicts whole models: the ones not written to for max_age seconds,
+        then the least recently written ones until the cache fits in max_bytes
+        '''
+        stats = sorted(self.model_stats(), key=lambda row: row[2])
+        evicted = []
+        if max_age is not None:
+            for rm_id, _, created in stats:
+                if time.time() - created > max_age:
+                    evicted.append(rm_id)
+        if max_bytes is not None:
+            total = sum(size for rm_id, size, _ in stats if rm_id not in evicted)
+            for rm_id, size, _ in stats:
+                if total <= max_bytes:
+                    break
+                if rm_id not in evicted:
+                    evicted.append(rm_id)
+                    total -= size
+        for rm_id in evicted:
+            self.evict_model(rm_id)
+        return evicted
+
+    def clear(self):
+        shutil.rmtree(self.dir)
+        self.__init__(self.dir)
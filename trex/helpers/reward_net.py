@@ -0,0 +1,132 @@
+import torch
+import torch.nn as nn
+
+
+# actual reward learning network
+
+
+class RewardNet(nn.Module):
+    def __init__(self, output_abs=False):
+        super().__init__()
+        self.output_abs = output_abs
+
+        self.model = nn.Sequential(
+            nn.Conv2d(3, 32, 3, stride=1),
+            nn.MaxPool2d(4, stride=2),
+            nn.LeakyReLU(),
+            nn.Conv2d(32, 32, 3, stride=1),
+            nn.MaxPool2d(4, stride=2),
+            nn.LeakyReLU(),
+            nn.Conv2d(32, 32, 3, stride=1),
+            nn.LeakyReLU(),
+            nn.Flatten(),
+            nn.Linear(11*11*32, 64),
+            nn.LeakyReLU(),
+            nn.Linear(64, 1)
+        )
+        # self.model = nn.Sequential(
+        #     nn.Conv2d(3, 16, 7, stride=3),
+        #     nn.LeakyReLU(),
+        #     nn.Conv2d(16, 16, 5, stride=2),
+        #     nn.LeakyReLU(),
+        #     nn.Conv2d(16, 16, 3, stride=1),
+        #     nn.LeakyReLU(),
+        #     nn.Conv2d(16, 16, 3, stride=1),
+        #     nn.LeakyReLU(),
+        #     nn.Flatten(),
+        #     nn.Linear(16*16, 64),
+        #     nn.LeakyReLU(),
+        #     nn.Linear(64, 1)
+        # )
+
+    @property
+    def encoder(self):
+        '''convolutional part of the model, maps NCHW frames to flat embeddings'''
+        return self.model[:9]
+
+    @property
+    def head(self):
+        '''mlp part of the model, maps embeddings to rewards'''
+        return self.model[9:]
+
+    def freeze_encoder(self):
+        for p in self.encoder.parameters():
+            p.requires_grad = False
+
+    def load_encoder(self, rm_path, device):
+        '''copies the conv weights of a stored reward model'''
+        state_dict = torch.load(rm_path, map_location=torch.device(device))
+        n_encoder = len(self.encoder)
+        encoder_state = {k: v for k, v in state_dict.items()
+                         if int(k.split('.')[1]) < n_encoder}
+        self.load_state_dict(encoder_state, strict=False)
+
+    def frame_rewards(self, x):
+        '''
+        rewards of individual frames, x is either a batch of
+        NHWC frames or a batch of precomputed frame embeddings
+        '''
+        if x.dim() == 2:
+            r = self.head(x)
+        else:
+            r = self.model(x.permute(0, 3, 1, 2))  # get into NCHW format
+        if self.output_abs:
+            r = torch.abs(r)
+        return r
+
+    def predict_returns(self, traj):
+        '''calculate cumulative return of trajectory'''
+        r = self.frame_rewards(traj)
+        all_reward = torch.sum(r)
+        all_reward_abs = torch.sum(torch.abs(r))
+        return all_reward, all_reward_abs
+
+    def predict_batch_rewards(self, batch_obs):
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        with torch.no_grad():
+            x = torch.tensor(batch_obs, dtype=torch.float32).to(device)
+            # compute forward pass of reward network (we parallelize across
+            # frames so batch size is length of partial trajectory)
+            r = self.frame_rewards(x)
+            return r.cpu().numpy().flatten()
+
+    def forward(self, traj_i, traj_j):
+        '''compute cumulative return for each trajectory and return logits'''
+        all_r_i, abs_r_i = self.predict_returns(traj_i)
+        all_r_j, abs_r_j = self.predict_returns(traj_j)
+        return torch.stack((all_r_i, all_r_j)), abs_r_i + abs_r_j
+
+
+class StudentRewardNet(RewardNet):
+    '''
+    much smaller network, downsampling right away, meant to be distilled
+    from a trained RewardNet (see distill_reward.py)
+    '''
+    def __init__(self, output_abs=False):
+        nn.Module.__init__(self)
+        self.output_abs = output_abs
+
+        self.model = nn.Sequential(
+            nn.Conv2d(3, 16, 5, stride=3),
+            nn.LeakyReLU(),
+            nn.Conv2d(16, 16, 3, stride=2),
+            nn.LeakyReLU(),
+            nn.Conv2d(16, 16, 3, stride=2),
+            nn.LeakyReLU(),
+            nn.Flatten(),
+            nn.Linear(4*4*16, 32),
+            nn.LeakyReLU(),
+            nn.Linear(32, 1)
+        )
+
+    @property
+    def encoder(self):
+        return self.model[:7]
+
+    @property
+    def head(self):
+        return self.model[7:]
+
+
+# architectures of the stored models, as recorded in the registry
+ARCHS = {'trex': RewardNet, 'student': StudentRewardNet}
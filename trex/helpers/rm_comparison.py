@@ -0,0 +1,115 @@
+import os
+import hashlib
+
+import numpy as np
+from scipy.stats import rankdata
+
+from helpers.affine import least_l2_affine_batch
+
+
+def sample_frames(demos, num_frames, seed=0):
+    '''
+    samples frames uniformly from the demos, returns the frames and
+    an id of the sample, used to key the prediction cache
+    '''
+    rng = np.random.RandomState(seed)
+    lengths = np.array([len(d['observations']) for d in demos])
+    offsets = np.cumsum(np.append(0, lengths[:-1]))
+    frame_ids = np.sort(rng.choice(lengths.sum(), min(num_frames, lengths.sum()), replace=False))
+    demo_ids = np.searchsorted(offsets, frame_ids, side='right') - 1
+
+    frames = np.stack([demos[d]['observations'][f - offsets[d]] for d, f in zip(demo_ids, frame_ids)])
+
+    h = hashlib.sha1()
+    h.update(' '.join(d['demo_id'] for d in demos).encode())
+    h.update(frame_ids.tobytes())
+    return frames, h.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Columnar cache of per-frame predictions on a fixed frame sample:
+    one .npy column per reward model in cache_dir/sample_id/
+    """
+
+    def __init__(self, cache_dir, sample_id):
+        self.dir = os.path.join(cache_dir, sample_id)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, rm_id):
+        return os.path.join(self.dir, rm_id + '.npy')
+
+    def __contains__(self, rm_id):
+        return os.path.exists(self.path(rm_id))
+
+    def get(self, rm_id):
+        return np.load(self.path(rm_id))
+
+    def put(self, rm_id, preds):
+        tmp_path = f'{self.path(rm_id)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, preds.astype(np.float32))
+        os.replace(tmp_path, self.path(rm_id))
+
+    def matrix(self, rm_ids):
+        '''predictions of the models stacked into a (n_models, n_frames) matrix'''
+        return np.stack([self.get(rm_id) for rm_id in rm_ids])
+
+
+def score_models(models, frames, cache, batch_size=512):
+    '''
+    computes the per-frame predictions of every model not in the cache yet.
+    models maps rm_id to its (lazily loaded) registry entry, see RewardModelRegistry.lookup
+    '''
+    for rm_id, model in models.items():
+        if rm_id in cache:
+            continue
+        preds = np.concatenate([model.predict_batch_rewards(frames[i:i+batch_size])
+                                for i in range(0, len(frames), batch_size)])
+        cache.put(rm_id, preds)
+
+    return cache.matrix(list(models))
+
+
+def canonicalize(preds):
+    '''shifts and scales every row to zero mean and unit variance'''
+    preds = preds - preds.mean(axis=1, keepdims=True)
+    std = preds.std(axis=1, keepdims=True)
+    return np.divide(preds, std, out=np.zeros_like(preds), where=std > 0)
+
+
+def pairwise_metrics(preds):
+    '''
+    Pairwise comparison of all of the models, given their predictions
+    on the same frames as a (n_models, n_frames) matrix. Returns a dict of
+    (n_models, n_models) matrices:
+        pearson, spearman: correlations of the predictions
+        pearson_distance: sqrt((1 - pearson) / 2) of the canonicalized predictions
+        affine_distance: rms error left after the best affine alignment
+            (with non-negative scale, see least_l2_affine_batch) of model i to model j,
+            in units of the standard deviation of the target model j
+    '''
+    preds = np.asarray(preds, dtype=np.float64)
+    n_frames = preds.shape[1]
+
+    z = canonicalize(preds)
+    pearson = z @ z.T / n_frames
+
+    ranks = canonicalize(rankdata(preds, axis=1))
+    spearman = ranks @ ranks.T / n_frames
+
+    # all of the models aligned to one target model per call
+    affine_distance = np.ones((len(preds), len(preds)))
+    for j, target in enumerate(preds):
+        targets = np.broadcast_to(target, preds.shape)
+        shifts, scales = least_l2_affine_batch(preds, targets)
+        residuals = scales[:, None] * preds + shifts[:, None] - targets
+        if target.std() > 0:
+            affine_distance[:, j] = np.sqrt(np.mean(residuals ** 2, axis=1)) / target.std()
+
+    return {
+        'pearson': pearson,
+        'spearman': spearman,
+        'pearson_distance': np.sqrt(np.clip((1 - pearson) / 2, 0, None)),
+        'affine_distance': affine_distance
+    }
@@ -0,0 +1,120 @@
+import os
+import glob
+import time
+import json
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+
+DEFAULT_REGISTRY = 'reward_models/rm_registry.sqlite'
+
+FIELDS = ['rm_id', 'path', 'sha1', 'arch', 'output_abs', 'env_name', 'mode',
+          'sequential', 'num_dems', 'seed', 'run_dir', 'metadata', 'created']
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class RegisteredModel:
+    """
+    Registry entry of a reward model. The network itself is only
+    loaded on the first access of .net (or on the first prediction)
+    """
+
+    def __init__(self, entry, device=None):
+        self.entry = entry
+        self.device = device
+        self._net = None
+
+    def __getattr__(self, name):
+        if name in FIELDS:
+            return self.entry[name]
+        raise AttributeError(name)
+
+    @property
+    def net(self):
+        if self._net is None:
+            # torch is only imported once a model is actually needed
+            from helpers.rm_runtime import RewardModelRuntime
+
+            self._net = RewardModelRuntime(self.entry['path'], output_abs=bool(self.entry['output_abs']),
+                                           device=self.device, arch=self.entry['arch'])
+        return self._net
+
+    def predict_batch_rewards(self, batch_obs):
+        return self.net.predict_batch_rewards(batch_obs)
+
+
+class RewardModelRegistry:
+    """
+    Index of the stored reward models: rm_id -> artifact path, hash,
+    architecture flags and training metadata, kept in an sqlite file
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS models ('
+                       'rm_id TEXT PRIMARY KEY, path TEXT, sha1 TEXT, arch TEXT, output_abs INTEGER, '
+                       'env_name TEXT, mode TEXT, sequential INTEGER, num_dems INTEGER, seed INTEGER, '
+                       'run_dir TEXT, metadata TEXT, created REAL)')
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def register(self, rm_id, path, arch='trex', output_abs=False, env_name=None, mode=None,
+                 sequential=None, num_dems=None, seed=None, run_dir=None, metadata=None):
+        entry = (rm_id, os.path.abspath(path), file_sha1(path), arch, int(output_abs), env_name, mode,
+                 sequential, num_dems, seed, run_dir, json.dumps(metadata or {}), time.time())
+        with self._db() as db:
+            db.execute(f'INSERT OR REPLACE INTO models VALUES ({", ".join("?" * len(FIELDS))})', entry)
+
+    def register_from_args(self, path, args, metadata=None):
+        '''registers a model trained by train_reward.py, given its config'''
+        self.register(args.rm_id, path, arch='trex', output_abs=args.output_abs,
+                      env_name=args.env_name, mode=args.distribution_mode, sequential=args.sequential,
+                      num_dems=args.num_dems, seed=args.seed, run_dir=args.run_dir, metadata=metadata)
+
+    def entry(self, rm_id):
+        with self._db() as db:
+            row = db.execute('SELECT * FROM models WHERE rm_id=?', (rm_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(FIELDS, row))
+        entry['metadata'] = json.loads(entry['metadata'])
+        return entry
+
+    def lookup(self, rm_id, device=None):
+        '''
+        returns the (lazily loaded) model. Models stored before the registry existed
+        are found by searching the working tree once, and registered on the way
+        '''
+        entry = self.entry(rm_id)
+        if entry is None:
+            paths = glob.glob('./**/' + rm_id + '.rm', recursive=True)
+            if not paths:
+                raise KeyError(f'Reward model {rm_id} is neither registered nor found under {os.getcwd()}')
+            print(f'Reward model {rm_id} is not registered, registering {paths[0]}')
+            self.register(rm_id, paths[0])
+            entry = self.entry(rm_id)
+        return RegisteredModel(entry, device)
+
+    def get_path(self, rm_id):
+        return self.lookup(rm_id).path
+
+    def all_entries(self):
+        with self._db() as db:
+            rows = db.execute('SELECT * FROM models').fetchall()
+        return [dict(zip(FIELDS, row)) for row in rows]
@@ -0,0 +1,63 @@
+"""
+Minimal runtime for the stored reward models: needs only torch and numpy,
+so policy workers and plotting scripts can import it without pulling in
+the training code (pandas, tensorflow, scipy, yaml)
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+
+from helpers.reward_net import ARCHS
+
+
+class FrameRewards(nn.Module):
+    '''batch of NHWC frames -> flat batch of rewards, the form that gets scripted'''
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net.frame_rewards(x).view(-1)
+
+
+class RewardModelRuntime:
+    """
+    Inference-only wrapper of a stored reward model, either a state dict (.rm)
+    of one of the ARCHS or a TorchScript export (.pt)
+    """
+
+    def __init__(self, path, output_abs=False, device=None, arch='trex'):
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        if path.endswith('.pt'):
+            self.model = torch.jit.load(path, map_location=self.device)
+        else:
+            net = ARCHS[arch](output_abs=output_abs)
+            net.load_state_dict(torch.load(path, map_location=self.device))
+            self.model = FrameRewards(net)
+        self.model.to(self.device).eval()
+
+    def predict_batch_rewards(self, batch_obs, batch_size=None):
+        '''per-frame rewards of a batch of observations, as a numpy array'''
+        batch_size = batch_size or len(batch_obs)
+        rewards = []
+        with torch.no_grad():
+            for i in range(0, len(batch_obs), batch_size):
+                x = torch.as_tensor(np.asarray(batch_obs[i:i+batch_size]), dtype=torch.float32).to(self.device)
+                rewards.append(self.model(x).cpu().numpy())
+        return np.concatenate(rewards) if rewards else np.empty(0, dtype=np.float32)
+
+    __call__ = predict_batch_rewards
+
+
+def export_torchscript(rm_path, out_path, output_abs=False, arch='trex', obs_shape=(64, 64, 3)):
+    '''traces a stored reward model into a standalone TorchScript file'''
+    net = ARCHS[arch](output_abs=output_abs)
+    net.load_state_dict(torch.load(rm_path, map_location=torch.device('cpu')))
+    model = FrameRewards(net).eval()
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, torch.zeros((1, *obs_shape)))
+    scripted.save(out_path)
+    return out_path
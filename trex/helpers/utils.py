@@ -1,25 +1,26 @@
 import os
 import glob
 import pickle 
-import tensorflow as tf
 import numpy as np
 from shutil import copy2
 
-import yaml
 import time
 import json
 import csv
 
-from scipy.stats import pearsonr
-from scipy.stats import spearmanr
+from helpers.demo_compression import load_compressed_demo
+from helpers.demo_replay import load_replay_demo
+from helpers.rm_registry import RewardModelRegistry
 
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# tensorflow, scipy and yaml are only imported by the functions using them, so that
+# the analysis scripts importing a couple of helpers start fast
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
 # use yaml config files; note what is actually set via the config file
 def add_yaml_args(args, config_file):
     if config_file:
+        import yaml
         config = yaml.safe_load(open(config_file))
         dic = vars(args)
         # all(map(dic.pop, config))
@@ -111,7 +112,17 @@ def store_model(state_dict_path, max_return, max_length, accs, args):
     save_path = os.path.join(model_dir, args.rm_id + '.rm')
     copy2(state_dict_path, save_path)
 
-    train_acc, val_acc, test_acc, pearson, spearman = accs
+    # numpy scalars (e.g. the float32 demo returns) are not JSON serializable
+    max_return, max_length = float(max_return), int(max_length)
+    train_acc, val_acc, test_acc, pearson, spearman = [float(acc) for acc in accs]
+    metadata = {'max_return': max_return, 'max_length': max_length, 'save_name': args.save_name,
+                'frozen_encoder': args.frozen_encoder,
+                'min_snippet_length': args.min_snippet_length,
+                'train_acc': train_acc, 'val_acc': val_acc, 'test_acc': test_acc,
+                'pearson': pearson, 'spearman': spearman}
+    registry = RewardModelRegistry(os.path.join(args.save_dir, 'rm_registry.sqlite'))
+    registry.register_from_args(save_path, args, metadata)
+
     with open(info_path, 'a') as f:
         rew_writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
         rew_writer.writerow([args.rm_id, 'trex', args.env_name, args.distribution_mode,
@@ -119,20 +130,52 @@ def store_model(state_dict_path, max_return, max_length, accs, args):
                             train_acc, val_acc, test_acc, pearson, spearman])
 
 
-def get_demo(demo_id):
-    # searches for the file with the given name in all subfolders,
-    # then loads it and returns
-    path = glob.glob('./**/' + demo_id + '.demo', recursive=True)[0]
+DEMO_FORMATS = ['.demo', '.cdemo', '.rdemo']
+
+
+def load_demo(path):
+    # loads a demo file of any of the supported formats
+    if path.endswith('.cdemo'):
+        return load_compressed_demo(path)
+    if path.endswith('.rdemo'):
+        return load_replay_demo(path)
     demo = pickle.load(open(path, 'rb'))
 
     return demo
 
 
-def get_corr_with_ground(demos, net, verbose=False, baseline_reward=False):
+def get_demo(demo_id):
+    # searches for the file with the given name in all subfolders,
+    # then loads it and returns. Plain .demo, compressed .cdemo and
+    # action-replay .rdemo files are accepted, in this order of preference
+    paths = glob.glob('./**/' + demo_id + '.*demo', recursive=True)
+    path = sorted(paths, key=lambda p: DEMO_FORMATS.index(os.path.splitext(p)[1]))[0]
+
+    return load_demo(path)
+
+
+def find_demo_paths(root='.'):
+    # a single walk over the folders, returns a dict demo_id -> path of the preferred format
+    paths = {}
+    for path in glob.glob(os.path.join(root, '**', '*.*demo'), recursive=True):
+        demo_id, ext = os.path.splitext(os.path.basename(path))
+        if ext not in DEMO_FORMATS:
+            continue
+        if demo_id not in paths or DEMO_FORMATS.index(ext) < DEMO_FORMATS.index(os.path.splitext(paths[demo_id])[1]):
+            paths[demo_id] = path
+    return paths
+
+
+def get_corr_with_ground(demos, net, verbose=False, baseline_reward=False, pred_returns=None):
+    # pred_returns can hold already computed predicted returns of the demos
+    from scipy.stats import pearsonr, spearmanr
+
     rs = []
-    for dem in demos:
+    for i, dem in enumerate(demos):
         if baseline_reward:
             r_prediction = len(dem['observations'])
+        elif pred_returns is not None:
+            r_prediction = pred_returns[i]
         else:
             r_prediction = np.sum(net.predict_batch_rewards(dem['observations']))
 
@@ -1,10 +1,6 @@
-import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
 from helpers.utils import filter_csv_pandas
 
-from scipy.stats import pearsonr, spearmanr
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--env_name', default='fruitbot')
 parser.add_argument('--distribution_mode', default='easy')
@@ -18,6 +14,11 @@ parser.add_argument('--baseline_reward', action='store_true')
 
 args = parser.parse_args()
 
+# the plotting and stats stack is only needed once the arguments are valid
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy.stats import pearsonr, spearmanr
+
 
 # def get_baseline_corrs(demos):
 #     pearson_r, pearson_p = pearsonr(demos['length'], demos['returns'])
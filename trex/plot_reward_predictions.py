@@ -1,13 +1,13 @@
 import argparse
-import glob
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import numpy as np
-from train_reward import RewardNet
-import torch
 import pandas as pd
 
 from helpers.utils import filter_csv_pandas, get_demo
+from helpers.reward_cache import RewardCache
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+from helpers.affine import least_l2_affine_batch
 
 mpl.rcParams['axes.prop_cycle'] = mpl.cycler(color=["mediumspringgreen", "salmon"]) 
 
@@ -19,16 +19,16 @@ parser.add_argument('--sequential', type=int, default=0)
 parser.add_argument('--demo_csv', default='demos/demo_infos.csv')
 parser.add_argument('--reward_csv', default='reward_models/rm_infos.csv')
 parser.add_argument('--rm_id', type=str, help='reward model id')
+parser.add_argument('--cache_dir', default='reward_cache', help='cache of the predicted rewards')
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY, help='registry of the stored reward models')
 
 args = parser.parse_args()
 
 
-# find the reward model and load it
-path = glob.glob('./**/' + args.rm_id + '.rm', recursive=True)[0]
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-net = RewardNet().to(device)
-net.load_state_dict(torch.load(path, map_location=torch.device(device)))
-reward_function = lambda x: net.predict_batch_rewards(x)
+# the reward model gets loaded only on the first cache miss
+net = RewardModelRegistry(args.rm_registry).lookup(args.rm_id)
+cache = RewardCache(args.cache_dir)
+reward_function = lambda demo: cache.get_or_compute(args.rm_id, demo, net.predict_batch_rewards)
 
 # find the relevant demos and filter them
 demo_infos = pd.read_csv(args.demo_csv)
@@ -58,14 +58,16 @@ if args.reward_csv is not None:
 
 fig, axs = plt.subplots(2, 3, sharex=True, sharey=True, figsize=(12, 7))
 
-true_rews = dems[0][1]['rewards']
-pred_rews = reward_function(dems[0][1]['observations'])
-norm_const = abs(np.sum(true_rews)/np.sum(pred_rews))
+# one scale for the model, fitted on the cumulative rewards of all of the demos shown,
+# so that the panels keep the relative predicted returns of the demos
+shown = dems[:len(fig.axes)]
+true_cums = [np.cumsum(demo['rewards']) for _, demo in shown]
+pred_cums = [np.cumsum(reward_function(demo)) for _, demo in shown]
+pred_concat, true_concat = np.concatenate(pred_cums), np.concatenate(true_cums)
+_, (scale,) = least_l2_affine_batch(pred_concat, true_concat, [0, len(pred_concat)], shift=False)
 
 for i, ax in enumerate(fig.axes):
-    demo_id, demo = dems[i]
-    true_rews = demo['rewards']
-    pred_rews = reward_function(demo['observations'])
+    demo_id, _ = shown[i]
 
     # matplotlib formatting
     ax.set_title(demo_id)
@@ -79,8 +81,8 @@ for i, ax in enumerate(fig.axes):
     ax.tick_params(axis='both', color='white')
 
     # plot cumulative rewards for demonstration
-    ax.plot(np.cumsum(true_rews), lw=2, label='true')
-    ax.plot(np.cumsum(pred_rews) * norm_const, lw=2, label='predicted')
+    ax.plot(true_cums[i], lw=2, label='true')
+    ax.plot(pred_cums[i] * scale, lw=2, label='predicted')
 
 fig.text(0.5, 0.04, 'timestep', ha='center', va='center', fontsize=22)
 fig.text(0.06, 0.5, 'cumulative reward', ha='center', va='center', rotation='vertical', fontsize=22)
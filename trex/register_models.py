@@ -0,0 +1,37 @@
+import os
+import glob
+import argparse
+
+import pandas as pd
+
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+
+parser = argparse.ArgumentParser(description='Adds the reward models stored before the registry existed to the registry')
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY)
+parser.add_argument('--rm_csv', nargs='+', default=glob.glob('reward_models/rm_infos*.csv'),
+                    help='results tables to take the model metadata from')
+
+args = parser.parse_args()
+
+registry = RewardModelRegistry(args.rm_registry)
+
+infos = {}
+for path in args.rm_csv:
+    for _, row in pd.read_csv(path, dtype={'rm_id': str}).iterrows():
+        infos[row['rm_id']] = row
+
+n_registered = 0
+for path in glob.glob('./**/*.rm', recursive=True):
+    rm_id = os.path.basename(path)[:-len('.rm')]
+    if registry.entry(rm_id) is not None:
+        continue
+    info = infos.get(rm_id)
+    if info is None:
+        registry.register(rm_id, path)
+    else:
+        registry.register(rm_id, path, env_name=info['env_name'], mode=info['mode'],
+                          sequential=int(info['sequential']), num_dems=int(info['num_dems']),
+                          metadata={k: info[k] for k in ['train_acc', 'val_acc', 'test_acc', 'pearson', 'spearman']})
+    n_registered += 1
+
+print(f'{n_registered} models registered, {len(registry.all_entries())} in {args.rm_registry}')
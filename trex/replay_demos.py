@@ -0,0 +1,43 @@
+import os
+import glob
+import pickle
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from helpers.demo_replay import seed_from_demo_id, make_replay_demo, verify_replay
+
+parser = argparse.ArgumentParser(description='Converts demos into the action-replay .rdemo format and verifies them')
+parser.add_argument('--demo_dir', type=str, default='demos/demo_files')
+parser.add_argument('--convert', action='store_true', help='write a .rdemo file next to every .demo file')
+parser.add_argument('--verify', action='store_true',
+                    help='replay every .rdemo file and check the rewards against the stored ones')
+parser.add_argument('--no_backgrounds', action='store_true', help='the demos were generated without backgrounds')
+parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+
+args = parser.parse_args()
+
+if args.convert:
+    demo_paths = sorted(glob.glob(os.path.join(args.demo_dir, '*.demo')))
+    size_before, size_after = 0, 0
+    for path in demo_paths:
+        demo = pickle.load(open(path, 'rb'))
+        seed = demo.get('seed', seed_from_demo_id(demo['demo_id'], demo['sequential']))
+        rdemo = make_replay_demo(demo, seed, use_backgrounds=not args.no_backgrounds)
+        rpath = path[:-len('.demo')] + '.rdemo'
+        with open(rpath, 'wb') as f:
+            pickle.dump(rdemo, f)
+        size_before += os.path.getsize(path)
+        size_after += os.path.getsize(rpath)
+    print(f'{len(demo_paths)} demos converted: {size_before / 2**20:.1f} MB -> {size_after / 2**20:.2f} MB')
+
+if args.verify:
+    rdemo_paths = sorted(glob.glob(os.path.join(args.demo_dir, '*.rdemo')))
+    rdemos = [pickle.load(open(path, 'rb')) for path in rdemo_paths]
+    with Pool(args.num_workers) as pool:
+        matches = pool.map(verify_replay, rdemos)
+    for path, match in zip(rdemo_paths, matches):
+        if not match:
+            print(f'Replayed rewards do not match: {path}')
+    print(f'{np.sum(matches)}/{len(matches)} demos replayed correctly')
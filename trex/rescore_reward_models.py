@@ -0,0 +1,146 @@
+import os
+import time
+import argparse
+from multiprocessing import Pool, Value
+
+import numpy as np
+import pandas as pd
+import torch
+from scipy.stats import pearsonr, spearmanr
+
+from helpers.utils import filter_csv_pandas, find_demo_paths, load_demo
+from helpers.reward_cache import RewardCache
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
+
+parser = argparse.ArgumentParser(description='Re-scores all of the reward models of a results table on the test demos')
+parser.add_argument('--rm_csv', default='reward_models/rm_infos.csv', help='results table to refresh')
+parser.add_argument('--demo_csv', default='demos/demo_infos.csv')
+parser.add_argument('--scores_csv', default=None,
+                    help='per (model, demo) predicted returns, defaults to rm_demo_scores.csv next to rm_csv')
+parser.add_argument('--cache_dir', default='reward_cache', help='cache of the per-frame predicted rewards')
+parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY, help='registry of the stored reward models')
+parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+parser.add_argument('--demos_per_task', type=int, default=None,
+                    help='number of demos each worker task streams, by default the demos of a group are split evenly between the workers')
+
+# default --min_snippet_length of train_reward.py, for the models registered without theirs
+DEFAULT_MIN_SNIPPET_LENGTH = 20
+
+
+def init_worker(counter):
+    '''gives every worker its own device, round robin over the gpus'''
+    global worker_device
+    with counter.get_lock():
+        k = counter.value
+        counter.value += 1
+    n_gpus = torch.cuda.device_count()
+    worker_device = torch.device(f'cuda:{k % n_gpus}') if n_gpus else torch.device('cpu')
+
+
+def score_demos(task):
+    '''
+    worker: loads every model of the group once, then streams
+    its share of the test demos, evaluating all of the models on each demo
+    '''
+    registry_path, rm_ids, demo_tasks, cache_dir = task
+    device = worker_device
+    cache = RewardCache(cache_dir)
+    # loaded through the runtime (architecture, output_abs) as in the other tools sharing the cache,
+    # once per worker and only if some of their rewards are not cached
+    registry = RewardModelRegistry(registry_path)
+    models = {rm_id: registry.lookup(rm_id, device) for rm_id in rm_ids}
+
+    def predict_rewards(rm_id, observations):
+        return models[rm_id].predict_batch_rewards(observations)
+
+    rows = []
+    for demo_path, demo_id, missing_rm_ids in demo_tasks:
+        demo = load_demo(demo_path)
+        demo['demo_id'] = demo_id
+        for rm_id in missing_rm_ids:
+            rewards = cache.get_or_compute(rm_id, demo, lambda x: predict_rewards(rm_id, x))
+            rows.append((rm_id, demo_id, float(np.sum(rewards))))
+    return rows
+
+
+def main():
+    args = parser.parse_args()
+    if args.scores_csv is None:
+        args.scores_csv = os.path.join(os.path.dirname(args.rm_csv), 'rm_demo_scores.csv')
+
+    rm_infos = pd.read_csv(args.rm_csv, dtype={'rm_id': str})
+    demo_infos = pd.read_csv(args.demo_csv, dtype={'demo_id': str})
+    if os.path.exists(args.scores_csv):
+        scores = pd.read_csv(args.scores_csv, dtype={'rm_id': str, 'demo_id': str})
+    else:
+        scores = pd.DataFrame(columns=['rm_id', 'demo_id', 'pred_return'])
+    scored = set(zip(scores['rm_id'], scores['demo_id']))
+
+    registry = RewardModelRegistry(args.rm_registry)
+    # one walk over the working tree for all of the demos
+    demo_paths = find_demo_paths()
+
+    # the test demos a model is scored on are filtered as in its training (demo_min_len)
+    min_lens = {}
+    tasks = []
+    for (env_name, mode, sequential), group in rm_infos.groupby(['env_name', 'mode', 'sequential']):
+        constraints = {'set_name': 'test', 'env_name': env_name, 'mode': mode, 'sequential': sequential}
+        test_demos = filter_csv_pandas(demo_infos, constraints)
+        rm_ids = []
+        for rm_id in group['rm_id']:
+            try:
+                metadata = registry.lookup(rm_id).metadata
+            except KeyError:
+                continue
+            rm_ids.append(rm_id)
+            min_lens[rm_id] = metadata.get('min_snippet_length') or DEFAULT_MIN_SNIPPET_LENGTH
+        if len(rm_ids) < len(group):
+            print(f'{len(group) - len(rm_ids)} models of {env_name} are missing their .rm file')
+
+        demo_tasks = []
+        for demo_id, length in zip(test_demos['demo_id'], test_demos['length']):
+            missing = [rm_id for rm_id in rm_ids
+                       if (rm_id, demo_id) not in scored and length > min_lens[rm_id]]
+            if missing and demo_id in demo_paths:
+                demo_tasks.append((demo_paths[demo_id], demo_id, missing))
+        demos_per_task = args.demos_per_task or max(1, int(np.ceil(len(demo_tasks) / args.num_workers)))
+        for i in range(0, len(demo_tasks), demos_per_task):
+            tasks.append((args.rm_registry, rm_ids, demo_tasks[i:i+demos_per_task], args.cache_dir))
+
+    n_pairs = sum(len(missing) for _, _, demo_tasks, _ in tasks for _, _, missing in demo_tasks)
+    print(f'{len(rm_infos)} models, {n_pairs} (model, demo) pairs to score in {len(tasks)} tasks')
+
+    t = time.time()
+    new_rows = []
+    with Pool(args.num_workers, initializer=init_worker, initargs=(Value('i', 0),)) as pool:
+        for rows in pool.imap_unordered(score_demos, tasks):
+            new_rows.extend(rows)
+            # store as we go, so that an interrupted job does not have to start over
+            pd.DataFrame(rows, columns=['rm_id', 'demo_id', 'pred_return']).to_csv(
+                args.scores_csv, mode='a', header=not os.path.exists(args.scores_csv), index=False)
+    print(f'scored {len(new_rows)} pairs in {time.time() - t:.1f}s')
+
+    scores = pd.concat([scores, pd.DataFrame(new_rows, columns=['rm_id', 'demo_id', 'pred_return'])])
+    scores['pred_return'] = scores['pred_return'].astype(float)
+    scores = scores.merge(demo_infos[['demo_id', 'return', 'length']], on='demo_id')
+    # also drops the pairs scored before the filter was applied
+    scores = scores[scores['length'] > scores['rm_id'].map(min_lens)]
+
+    # refresh the correlations of every model with all of its scored test demos
+    rm_infos[['pearson', 'spearman']] = rm_infos[['pearson', 'spearman']].astype(float)
+    for rm_id, model_scores in scores.groupby('rm_id'):
+        if len(model_scores) < 2:
+            continue
+        pearson, _ = pearsonr(model_scores['return'], model_scores['pred_return'])
+        spearman, _ = spearmanr(model_scores['return'], model_scores['pred_return'])
+        rows = rm_infos['rm_id'] == rm_id
+        rm_infos.loc[rows, 'pearson'] = pearson
+        rm_infos.loc[rows, 'spearman'] = spearman
+        rm_infos.loc[rows, 'n_test_demos'] = len(model_scores)
+
+    rm_infos.to_csv(args.rm_csv, index=False)
+    print(f'Updated correlations saved to {args.rm_csv}')
+
+
+if __name__ == '__main__':
+    main()
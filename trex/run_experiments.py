@@ -1,7 +1,15 @@
+import os
+import csv
+import glob
+import time
+import random
+import signal
 import subprocess
 import argparse
 from itertools import product
 
+import numpy as np
+
 parser = argparse.ArgumentParser(description='Experiments parameters')
 
 parser.add_argument('--env_name', type=str, nargs='+', default=['starpilot'])
@@ -19,18 +27,91 @@ parser.add_argument('--weight_decay', type=float, default=[0.005], nargs='+',
 parser.add_argument('--pass_args', default=None, type=str,
                     help="The specified string in quotes would be passed to the train_reward.py script")
 
+# asynchronous successive halving
+parser.add_argument('--asha', action='store_true',
+                    help='run the experiments in parallel, stopping the ones with bad intermediate val_acc')
+parser.add_argument('--max_parallel', type=int, default=4, help='number of experiments running at the same time')
+parser.add_argument('--max_num_epochs', type=int, default=50, help='passed to train_reward.py, last possible rung')
+parser.add_argument('--min_epochs', type=int, default=2, help='epochs before the first rung')
+parser.add_argument('--eta', type=int, default=3,
+                    help='rungs are min_epochs * eta^k epochs, only the top 1/eta of the experiments pass each rung')
+parser.add_argument('--log_dir', default='LOGS/RM_LOGS', help='passed to train_reward.py, where the train logs are read from')
+parser.add_argument('--poll_interval', type=float, default=10, help='seconds between reads of the train logs')
+
 args = parser.parse_args()
 
-n_exps = 0
 
-print('Running experiments')
+def read_val_accs(rm_id):
+    '''val_acc of every finished epoch of the run, empty until its train log exists'''
+    paths = glob.glob(os.path.join(args.log_dir, rm_id, '*', 'train_log.csv'))
+    if not paths:
+        return []
+    with open(paths[0]) as f:
+        rows = list(csv.DictReader(f, delimiter=',', quotechar='|'))
+    return [float(row['val_acc']) for row in rows]
+
+
+def run_asha(commands):
+    '''
+    Asynchronous successive halving: up to max_parallel experiments run at once.
+    Whenever a running experiment reaches a rung, its best val_acc so far is compared
+    with the ones of all of the experiments that reached the rung before. Outside of their
+    top 1/eta it is stopped, and its slot is given to the next experiment waiting
+    '''
+    rungs = []
+    epochs = args.min_epochs
+    while epochs < args.max_num_epochs:
+        rungs.append(epochs)
+        epochs *= args.eta
+    rung_results = {rung: [] for rung in rungs}
+
+    pending = list(commands)
+    running = {}
+    results = []
+
+    while pending or running:
+        while pending and len(running) < args.max_parallel:
+            rm_id, command = pending.pop(0)
+            print(f'Running {rm_id}:\n{command}', flush=True)
+            # own process group, so that stopping it also stops the python process under the shell
+            proc = subprocess.Popen(command, shell=True, start_new_session=True)
+            running[rm_id] = {'proc': proc, 'rung': 0, 'command': command}
+
+        time.sleep(args.poll_interval)
+
+        for rm_id, run in list(running.items()):
+            # checked before reading the log, a finished run has all of its epochs logged
+            finished = run['proc'].poll() is not None
+            val_accs = read_val_accs(rm_id)
+            status = None
+            while run['rung'] < len(rungs) and len(val_accs) >= rungs[run['rung']]:
+                rung = rungs[run['rung']]
+                best = max(val_accs[:rung])
+                recorded = rung_results[rung]
+                recorded.append(best)
+                run['rung'] += 1
+                if not finished and len(recorded) > 1 and best < np.percentile(recorded, 100 * (1 - 1 / args.eta)):
+                    print(f'Stopping {rm_id} at rung {rung} epochs, val_acc {best:.4f}', flush=True)
+                    os.killpg(run['proc'].pid, signal.SIGTERM)
+                    run['proc'].wait()
+                    status = 'stopped'
+                    break
+            if status is None and finished:
+                status = 'finished' if run['proc'].returncode == 0 else 'failed'
+            if status is not None:
+                val_accs = read_val_accs(rm_id)
+                results.append([rm_id, status, len(val_accs), max(val_accs, default=np.nan), run['command']])
+                del running[rm_id]
+
+    return results
+
+
+commands = []
 
 for (seed, env_name, mode, num_dems, max_return, sequential, weight_decay) in \
     product(range(args.num_seeds), args.env_name, args.distribution_mode,
             args.num_dems, args.max_return, args.sequential, args.weight_decay):
 
-    n_exps += 1
-
     command = ['python', 'train_reward.py']
 
     command.append(f'--env_name={env_name}')
@@ -40,12 +121,39 @@ for (seed, env_name, mode, num_dems, max_return, sequential, weight_decay) in \
     command.append(f'--sequential={sequential}')
     command.append(f'--weight_decay={weight_decay}')
 
-    command.append(args.pass_args)
+    rm_id = None
+    if args.asha:
+        # the seed is fixed here, so that the reward model id (and with it the train log) is known
+        train_seed = random.randint(1e6, 1e7-1)
+        rm_id = '_'.join([str(train_seed)[:3], str(train_seed)[3:]])
+        command.append(f'--seed={train_seed}')
+        command.append(f'--max_num_epochs={args.max_num_epochs}')
+        command.append(f'--log_dir={args.log_dir}')
+
+    if args.pass_args is not None:
+        command.append(args.pass_args)
 
-    command = ' '.join(command)
+    commands.append((rm_id, ' '.join(command)))
+
+print('Running experiments')
 
-    print(f'Running:\n{command}')
+if args.asha:
+    results = run_asha(commands)
+    n_epochs = sum(row[2] for row in results)
+    print(f'Ran {len(results)} experiments, {n_epochs} epochs in total '
+          f'({n_epochs / (len(results) * args.max_num_epochs):.2f} of running all of them to {args.max_num_epochs} epochs)')
+    best = max(results, key=lambda row: -np.inf if np.isnan(row[3]) else row[3])
+    print(f'Best: {best[0]} with val_acc {best[3]:.4f}\n{best[4]}')
 
-    subprocess.call(command, shell=True)
+    summary_path = os.path.join(args.log_dir, f'asha_{time.strftime("%Y%m%d_%H%M%S")}.csv')
+    with open(summary_path, 'w') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['rm_id', 'status', 'epochs', 'best_val_acc', 'command'])
+        writer.writerows(results)
+    print(f'Summary saved to {summary_path}')
+else:
+    for _, command in commands:
+        print(f'Running:\n{command}')
+        subprocess.call(command, shell=True)
 
-print(f'Ran {n_exps} experiments.')
+    print(f'Ran {len(commands)} experiments.')
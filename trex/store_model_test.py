@@ -0,0 +1,38 @@
+import os
+import csv
+import argparse
+import tempfile
+
+import numpy as np
+
+from helpers.utils import store_model
+from helpers.rm_registry import RewardModelRegistry
+
+
+def numpy_scalars_test():
+    # the values train_reward.py passes: float32 demo returns, int64 lengths, numpy accuracies
+    with tempfile.TemporaryDirectory() as tmp:
+        state_dict_path = os.path.join(tmp, 'rm.pth')
+        with open(state_dict_path, 'wb') as f:
+            f.write(b'weights')
+        args = argparse.Namespace(save_dir=os.path.join(tmp, 'reward_models'), save_name=None, rm_id='123_4567',
+                                  env_name='starpilot', distribution_mode='easy', num_dems=10, sequential=0,
+                                  output_abs=False, seed=1234567, run_dir=tmp, frozen_encoder=False,
+                                  min_snippet_length=20)
+        accs = (np.float64(0.9), np.float64(0.8), np.float32(0.7), np.float64(0.6), np.float64(0.5))
+
+        store_model(state_dict_path, np.float32(12.5), np.int64(400), accs, args)
+
+        entry = RewardModelRegistry(os.path.join(args.save_dir, 'rm_registry.sqlite')).entry(args.rm_id)
+        assert entry['metadata']['max_return'] == 12.5
+        assert entry['metadata']['max_length'] == 400
+        assert entry['metadata']['min_snippet_length'] == 20
+        with open(os.path.join(args.save_dir, 'rm_infos.csv')) as f:
+            rows = list(csv.DictReader(f, delimiter=',', quotechar='|'))
+        assert len(rows) == 1 and rows[0]['rm_id'] == args.rm_id
+    print('Success! : model with numpy scalar metadata registered and logged')
+
+
+if __name__ == "__main__":
+
+    numpy_scalars_test()
@@ -1,9 +1,7 @@
 import os
-import glob
 import numpy as np
 
 import tensorflow as tf
-import torch
 from baselines.ppo2 import ppo2
 
 from baselines.common.models import build_impala_cnn
@@ -20,8 +18,9 @@ import argparse
 
 from helpers.ProxyRewardWrapper import ProxyRewardWrapper
 from helpers.utils import add_yaml_args, log_this
+from helpers.rm_registry import RewardModelRegistry, DEFAULT_REGISTRY
 
-from train_reward import RewardNet
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 
 def parse_config():
@@ -39,8 +38,11 @@ def parse_config():
     parser.add_argument('--use_sequential_levels', type=bool, default=False)
     parser.add_argument('--log_name', type=str, default='')
     parser.add_argument('--rm_id', default='', type=str, help="reward model id, e.g. 109_8714")
+    parser.add_argument('--rm_registry', default=DEFAULT_REGISTRY, type=str, help="registry of the stored reward models")
     parser.add_argument('--use_sigmoid', action='store_true', default=False,
                         help='whether to pass reward model output though sigmoid')
+    parser.add_argument('--reward_cache_size', type=int, default=0,
+                        help='number of distinct frames whose predicted rewards are kept in an LRU cache (0 disables it)')
 
     # logs every num_envs * nsteps
     parser.add_argument('--log_interval', type=int, default=5)
@@ -102,11 +104,8 @@ def main():
     venv = VecMonitor(venv=venv, filename=None, keep_buf=100)
 
     if args.rm_id:
-        # load pretrained network
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        net = RewardNet().to(device)
-        rm_path = glob.glob('./**/'+ args.rm_id + '.rm', recursive=True)[0]
-        net.load_state_dict(torch.load(rm_path, map_location=torch.device(device)))
+        # look up the pretrained network, it gets loaded on the first prediction
+        net = RewardModelRegistry(args.rm_registry).lookup(args.rm_id)
 
         # use batch reward prediction function instead of the ground truth reward function
         # pass though sigmoid if needed
@@ -119,7 +118,7 @@ def main():
         # rew_func = lambda x: x.shape[0] * [1]
 
         
-        venv = ProxyRewardWrapper(venv, rew_func)
+        venv = ProxyRewardWrapper(venv, rew_func, cache_size=args.reward_cache_size, rollout_steps=args.nsteps)
     else:
         # true environment rewards will be use
         pass
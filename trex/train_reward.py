@@ -7,7 +7,6 @@ import copy
 import torch
 import torch.nn as nn
 import torch.optim as optim
-import tensorflow as tf
 import pandas as pd
 
 import os
@@ -20,15 +19,23 @@ import logging
 
 from helpers.utils import get_demo, get_corr_with_ground, log_this,\
                          add_yaml_args, store_model, filter_csv_pandas
+from helpers.reward_net import RewardNet
+from helpers.embedding_cache import embed_demos
+from helpers.rm_registry import RewardModelRegistry
 
 sys.path.append('../')
 
 
 def create_dataset(dems, num_snippets, min_snippet_length, max_snippet_length,
-                   verbose=True, use_snippet_rewards=False, use_clip_heuristic=True):
+                   verbose=True, use_snippet_rewards=False, use_clip_heuristic=True,
+                   return_index=False):
     """
     This function takes a set of demonstrations and produces
     a training set consisting of pairs of clips with assigned preferences
+
+    If return_index is True, also returns an int array with a row
+    (demo0, start0, demo1, start1, length) per pair, where demo0/demo1
+    are positions in dems of the demos the two clips are taken from
     """
 
     if verbose:
@@ -40,13 +47,15 @@ def create_dataset(dems, num_snippets, min_snippet_length, max_snippet_length,
         assert min_snippet_length < min(demo_lens), "One of the trajectories is too short"
 
     data = []
+    index = []
     n_honest = 0
 
     while len(data) < num_snippets:
 
         # pick two random demos
         i1, i2 = np.random.choice(len(dems), 2, replace=False)
-        d0, d1 = sorted([dems[i1], dems[i2]], key=lambda x: x['return'])
+        i0, i1 = sorted([i1, i2], key=lambda i: dems[i]['return'])
+        d0, d1 = dems[i0], dems[i1]
         if d0['return'] == d1['return']:
             continue
 
@@ -72,84 +81,103 @@ def create_dataset(dems, num_snippets, min_snippet_length, max_snippet_length,
         clip0_rew = np.sum(d0['rewards'][d0_start : d0_start+cur_len])
         clip1_rew = np.sum(d1['rewards'][d1_start : d1_start+cur_len])
 
+        clip_index = [i0, d0_start, i1, d1_start, cur_len]
         if clip0_rew <= clip1_rew:
             n_honest += 1
         elif use_snippet_rewards:
             # swap if incorrectly labeled and using true snippet rewards
             clip0, clip1 = clip1, clip0
+            clip_index = [i1, d1_start, i0, d0_start, cur_len]
 
         data.append(([clip0, clip1], np.array([1])))
+        index.append(clip_index)
 
     logging.info(f'set length: {len(data)}')
 
+    if return_index:
+        return np.array(data), np.array(index, dtype=np.int64), n_honest/num_snippets
     return np.array(data), n_honest/num_snippets
 
-# actual reward learning network
-
-
-class RewardNet(nn.Module):
-    def __init__(self, output_abs=False):
-        super().__init__()
-        self.output_abs = output_abs
-
-        self.model = nn.Sequential(
-            nn.Conv2d(3, 32, 3, stride=1),
-            nn.MaxPool2d(4, stride=2),
-            nn.LeakyReLU(),
-            nn.Conv2d(32, 32, 3, stride=1),
-            nn.MaxPool2d(4, stride=2),
-            nn.LeakyReLU(),
-            nn.Conv2d(32, 32, 3, stride=1),
-            nn.LeakyReLU(),
-            nn.Flatten(),
-            nn.Linear(11*11*32, 64),
-            nn.LeakyReLU(),
-            nn.Linear(64, 1)
-        )
-        # self.model = nn.Sequential(
-        #     nn.Conv2d(3, 16, 7, stride=3),
-        #     nn.LeakyReLU(),
-        #     nn.Conv2d(16, 16, 5, stride=2),
-        #     nn.LeakyReLU(),
-        #     nn.Conv2d(16, 16, 3, stride=1),
-        #     nn.LeakyReLU(),
-        #     nn.Conv2d(16, 16, 3, stride=1),
-        #     nn.LeakyReLU(),
-        #     nn.Flatten(),
-        #     nn.Linear(16*16, 64),
-        #     nn.LeakyReLU(),
-        #     nn.Linear(64, 1)
-        # )
-
-    def predict_returns(self, traj):
-        '''calculate cumulative return of trajectory'''
-        x = traj.permute(0, 3, 1, 2)  # get into NCHW format
-        if self.output_abs:
-            r = torch.abs(self.model(x))
-        else:
-            r = self.model(x)
-        all_reward = torch.sum(r)
-        all_reward_abs = torch.sum(torch.abs(r))
-        return all_reward, all_reward_abs
 
-    def predict_batch_rewards(self, batch_obs):
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        with torch.no_grad():
-            # get into NCHW format
-            x = torch.tensor(batch_obs, dtype=torch.float32).permute(0, 3, 1, 2).to(device)
-            # compute forward pass of reward network (we parallelize across
-            # frames so batch size is length of partial trajectory)
-            if self.output_abs:
-                r = torch.abs(self.model(x))
-            else:
-                r = self.model(x) 
-            return r.cpu().numpy().flatten()
-
-    def forward(self, traj_i, traj_j):
-        '''compute cumulative return for each trajectory and return logits'''
-        all_r_i, abs_r_i = self.predict_returns(traj_i)
-        all_r_j, abs_r_j = self.predict_returns(traj_j)
-        return torch.stack((all_r_i, all_r_j)), abs_r_i + abs_r_j
+class SnippetFrames:
+    """
+    Frames of a set of demos, addressed by the snippet index rows
+    produced by create_dataset. Used to run the reward net only once
+    per unique frame in a batch of (possibly overlapping) snippets
+    """
+
+    def __init__(self, dems):
+        self.observations = [d['observations'] for d in dems]
+        lengths = [len(obs) for obs in self.observations]
+        self.offsets = np.cumsum([0] + lengths[:-1])
+
+    def batch_index(self, index):
+        '''
+        returns the unique global frame ids used by the batch of snippets,
+        the position of every snippet frame among the unique frames
+        and the snippet id of every snippet frame (2*i + clip for pair i)
+        '''
+        starts = (self.offsets[index[:, [0, 2]]] + index[:, [1, 3]]).reshape(-1)
+        lengths = np.repeat(index[:, 4], 2)
+        snippet_ids = np.repeat(np.arange(len(starts)), lengths)
+        # position of every frame inside its snippet
+        steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        frame_ids = np.repeat(starts, lengths) + steps
+        unique_ids, inverse = np.unique(frame_ids, return_inverse=True)
+        return unique_ids, inverse.reshape(-1), snippet_ids
+
+    def get_frames(self, frame_ids):
+        '''gathers frames given sorted global frame ids'''
+        demo_ids = np.searchsorted(self.offsets, frame_ids, side='right') - 1
+        frames = []
+        for d in np.unique(demo_ids):
+            frames.append(self.observations[d][frame_ids[demo_ids == d] - self.offsets[d]])
+        return np.concatenate(frames)
+
+class PrefixSumEvaluator:
+    """
+    Evaluates snippet pairs taken from a fixed set of demos with a single
+    pass of the reward net over all of the demo frames. The predicted return
+    of a snippet is the difference of two cumulative sums of frame rewards
+    """
+
+    def __init__(self, dems):
+        self.dems = dems
+        lengths = [len(d['observations']) for d in dems]
+        # every demo has an extra leading 0 in the cumulative sums
+        self.offsets = np.cumsum([0] + [length + 1 for length in lengths[:-1]])
+
+    def update(self, net):
+        '''runs the net over every frame of the demos'''
+        cums, abs_cums = [], []
+        for d in self.dems:
+            r = net.predict_batch_rewards(d['observations']).astype(np.float64)
+            cums.append(np.concatenate([[0], np.cumsum(r)]))
+            abs_cums.append(np.concatenate([[0], np.cumsum(np.abs(r))]))
+        self.cums = np.concatenate(cums)
+        self.abs_cums = np.concatenate(abs_cums)
+        # predicted return of each whole demo
+        self.returns = np.array([c[-1] for c in cums])
+
+    def snippet_returns(self, index):
+        '''predicted and absolute returns of the pairs, each of shape (n_pairs, 2)'''
+        starts = self.offsets[index[:, [0, 2]]] + index[:, [1, 3]]
+        ends = starts + index[:, [4]]
+        returns = self.cums[ends] - self.cums[starts]
+        abs_returns = self.abs_cums[ends] - self.abs_cums[starts]
+        return returns, abs_returns
+
+    def accuracy(self, index, labels, lam_l1):
+        '''same as RewardTrainer.calc_accuracy, for the pairs given by the snippet index'''
+        returns, abs_returns = self.snippet_returns(index)
+        # ties are resolved in favour of the first clip, as torch.max does
+        pred_labels = (returns[:, 1] > returns[:, 0]).astype(labels.dtype)
+        acc = np.mean(pred_labels == labels)
+
+        # cross entropy of the two-way softmax, plus the l1 penalty
+        log_z = np.logaddexp(returns[:, 0], returns[:, 1])
+        losses = log_z - returns[np.arange(len(labels)), labels] + lam_l1 * abs_returns.sum(1)
+        return acc, np.mean(losses)
 
 # trainer wrapper in order to make training the reward model a neat process
 
@@ -158,18 +186,38 @@ class RewardTrainer:
     def __init__(self, args, device):
         self.device = device
         self.net = RewardNet(output_abs=args.output_abs).to(device)
+        if args.frozen_encoder:
+            # only the mlp head is trained, on top of cached frame embeddings
+            self.net.freeze_encoder()
         self.best_model = copy.deepcopy(self.net.state_dict())
         self.args = args
 
     # Train the network
-    def learn_reward(self, train_set, val_set, test_set, test_dems):
+    def learn_reward(self, train_set, val_set, test_set, test_dems,
+                     train_frames=None, train_index=None, prefix_eval=None):
+        '''
+        if train_frames (SnippetFrames of the training demos) and train_index
+        (the snippet index of train_set) are given, the updates are done in batches
+        of args.batch_size pairs, running each unique frame of a batch only once
+
+        prefix_eval is an optional dict with 'train', 'val' and 'test' entries
+        (PrefixSumEvaluator of the demos, snippet index of the set). If given,
+        the accuracies, losses and correlations come from one pass over the demo frames
+        '''
         loss_criterion = nn.CrossEntropyLoss()
-        optimizer = optim.Adam(self.net.parameters(), lr=self.args.lr,
+        trainable_params = [p for p in self.net.parameters() if p.requires_grad]
+        optimizer = optim.Adam(trainable_params, lr=self.args.lr,
                                weight_decay=self.args.weight_decay)
 
         max_val_acc = 0
         eps_no_max = 0
 
+        train_labels = np.array([label[0] for _, label in train_set])
+        if prefix_eval is not None:
+            eval_labels = {'train': train_labels,
+                           'val': np.array([label[0] for _, label in val_set]),
+                           'test': np.array([label[0] for _, label in test_set])}
+
         with open(self.args.train_log, 'a') as csvfile:
             writer = csv.writer(csvfile, delimiter=',', quotechar='|',
                                 quoting=csv.QUOTE_MINIMAL)
@@ -181,45 +229,66 @@ class RewardTrainer:
                 epoch_loss = 0
                 reward_list = []
                 abs_reward_list = []
-                np.random.shuffle(train_set)
-                # each epoch consists of some updates - NOT passing through whole test set.
-                for i, ([traj_i, traj_j], label) in enumerate(train_set[:self.args.epoch_size]):
+                if train_frames is not None:
+                    # shuffled together, so that the pairs train_acc is computed on change every epoch too
+                    perm = np.random.permutation(len(train_set))
+                    train_set, train_index, train_labels = train_set[perm], train_index[perm], train_labels[perm]
+                    epoch_loss = self.train_batches(optimizer, loss_criterion, train_frames, train_index,
+                                                    train_labels, reward_list, abs_reward_list)
+                else:
+                    np.random.shuffle(train_set)
+                    # each epoch consists of some updates - NOT passing through whole test set.
+                    for i, ([traj_i, traj_j], label) in enumerate(train_set[:self.args.epoch_size]):
 
-                    ti = torch.from_numpy(traj_i).float().to(self.device)
-                    tj = torch.from_numpy(traj_j).float().to(self.device)
-                    lb = torch.from_numpy(label).to(self.device)
+                        ti = torch.from_numpy(traj_i).float().to(self.device)
+                        tj = torch.from_numpy(traj_j).float().to(self.device)
+                        lb = torch.from_numpy(label).to(self.device)
 
-                    optimizer.zero_grad()
+                        optimizer.zero_grad()
 
-                    # forward + backward + optimize
-                    outputs, abs_rewards = self.net.forward(ti, tj)
+                        # forward + backward + optimize
+                        outputs, abs_rewards = self.net.forward(ti, tj)
 
-                    reward_list.append(outputs[0].cpu().item())
-                    reward_list.append(outputs[1].cpu().item())
-                    abs_reward_list.append(abs_rewards.cpu().item())
+                        reward_list.append(outputs[0].cpu().item())
+                        reward_list.append(outputs[1].cpu().item())
+                        abs_reward_list.append(abs_rewards.cpu().item())
 
-                    outputs = outputs.unsqueeze(0)
+                        outputs = outputs.unsqueeze(0)
 
-                    # L1 regularization on the output
-                    l1_reg = abs_rewards * self.args.lam_l1
+                        # L1 regularization on the output
+                        l1_reg = abs_rewards * self.args.lam_l1
 
-                    loss = loss_criterion(outputs, lb) + l1_reg
-                    loss.backward()
-                    optimizer.step()
+                        loss = loss_criterion(outputs, lb) + l1_reg
+                        loss.backward()
+                        optimizer.step()
 
-                    item_loss = loss.item()
-                    epoch_loss += item_loss
+                        item_loss = loss.item()
+                        epoch_loss += item_loss
 
                 epoch_loss /= self.args.epoch_size
-                train_acc, train_loss = self.calc_accuracy(train_set[:1000])
-                # keep validation set to 1000
-                val_acc, val_loss = self.calc_accuracy(val_set[:1000])
-                test_acc, test_loss = self.calc_accuracy(test_set)
-                # calculating correlations on the subset
-                # of all test demos to save time
-                pearson, spearman = get_corr_with_ground(test_dems[:100], self.net)
+                if prefix_eval is None:
+                    train_acc, train_loss = self.calc_accuracy(train_set[:1000])
+                    # keep validation set to 1000
+                    val_acc, val_loss = self.calc_accuracy(val_set[:1000])
+                    test_acc, test_loss = self.calc_accuracy(test_set)
+                    # calculating correlations on the subset
+                    # of all test demos to save time
+                    pearson, spearman = get_corr_with_ground(test_dems[:100], self.net)
+                else:
+                    results = {}
+                    for set_name, (evaluator, index) in prefix_eval.items():
+                        evaluator.update(self.net)
+                        results[set_name] = evaluator.accuracy(index, eval_labels[set_name], self.args.lam_l1)
+                    train_acc, train_loss = results['train']
+                    val_acc, val_loss = results['val']
+                    test_acc, test_loss = results['test']
+                    test_evaluator = prefix_eval['test'][0]
+                    pearson, spearman = get_corr_with_ground(test_evaluator.dems, self.net,
+                                                             pred_returns=test_evaluator.returns)
 
                 writer.writerow([epoch*self.args.epoch_size, train_acc, train_loss.item(), val_acc, val_loss.item(), test_acc, test_loss.item(), pearson, spearman])
+                # flushed every epoch, sweeps read the intermediate results
+                csvfile.flush()
 
                 avg_reward = np.mean(np.array(reward_list))
                 avg_abs_reward = np.mean(np.array(abs_reward_list))
@@ -249,6 +318,56 @@ class RewardTrainer:
         logging.info("finished training")
         return os.path.join(self.args.run_dir, 'reward_best.pth'), accs
 
+    def batch_returns(self, frames, index):
+        '''
+        predicted returns of a batch of snippet pairs, shape (batch, 2),
+        and the summed absolute rewards of each pair.
+        Frames shared between the snippets go through the network only once,
+        autograd accumulates their gradients over all of the snippets using them
+        '''
+        unique_ids, inverse, snippet_ids = frames.batch_index(index)
+        x = torch.from_numpy(frames.get_frames(unique_ids)).float().to(self.device)
+        r = self.net.frame_rewards(x).view(-1)
+        r = r[torch.from_numpy(inverse).to(self.device)]
+
+        snippet_ids = torch.from_numpy(snippet_ids).to(self.device)
+        returns = torch.zeros(2 * len(index), device=self.device).index_add(0, snippet_ids, r)
+        abs_returns = torch.zeros(2 * len(index), device=self.device).index_add(0, snippet_ids, torch.abs(r))
+        return returns.view(-1, 2), abs_returns.view(-1, 2).sum(1), (len(unique_ids), len(inverse))
+
+    def train_batches(self, optimizer, loss_criterion, frames, index, labels, reward_list, abs_reward_list):
+        '''
+        one epoch of batched updates on the first epoch_size pairs of index
+        (shuffled by the caller), returns the summed loss over the pairs
+        '''
+        epoch_loss = 0
+        n_unique, n_frames = 0, 0
+        pairs = np.arange(min(len(index), self.args.epoch_size))
+        for b in range(0, len(pairs), self.args.batch_size):
+            batch = pairs[b : b+self.args.batch_size]
+            lb = torch.from_numpy(labels[batch]).to(self.device)
+
+            optimizer.zero_grad()
+
+            outputs, abs_rewards, (batch_unique, batch_frames) = self.batch_returns(frames, index[batch])
+
+            reward_list.extend(outputs.detach().cpu().numpy().flatten())
+            abs_reward_list.extend(abs_rewards.detach().cpu().numpy())
+
+            # L1 regularization on the output, averaged over pairs like the loss
+            l1_reg = abs_rewards.mean() * self.args.lam_l1
+
+            loss = loss_criterion(outputs, lb) + l1_reg
+            loss.backward()
+            optimizer.step()
+
+            epoch_loss += loss.item() * len(batch)
+            n_unique += batch_unique
+            n_frames += batch_frames
+
+        logging.info(f'   | unique frames: {n_unique} of {n_frames} snippet frames ({n_unique / n_frames:.1%})')
+        return epoch_loss
+
     # save the final learned model
     def save_model(self):
         torch.save(self.net.state_dict(), os.path.join(self.args.run_dir, 'reward_best.pth'))
@@ -310,6 +429,10 @@ def parse_config():
     parser.add_argument('--max_snippet_length', default=100, type=int, help="Max length of tracjectory for training comparison")
 
     parser.add_argument('--epoch_size', default=1000, type=int, help='How often to measure validation accuracy')
+    parser.add_argument('--prefix_sum_eval', action='store_true',
+                        help='evaluate all snippets from a single pass of the network over the demo frames')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='pairs per update, above 1 each unique frame of a batch goes through the network only once')
     parser.add_argument('--max_num_epochs', type=int, default=50, help='Number of epochs for reward learning')
     parser.add_argument('--patience', type=int, default=10, help='early stopping patience')
 
@@ -320,6 +443,15 @@ def parse_config():
     parser.add_argument('--use_snippet_rewards', action='store_true', help='use true rewards instead of demonstration ones')
     parser.add_argument('--use_clip_heuristic', type=bool, default=True, help='always pick later part of a better trajectory when generating clips')
 
+    parser.add_argument('--frozen_encoder', action='store_true',
+                        help='keep the conv encoder fixed and train only the mlp head on cached frame embeddings')
+    parser.add_argument('--encoder_rm_id', type=str, default=None,
+                        help='reward model to take the frozen encoder from, random encoder if not given')
+    parser.add_argument('--encoder_seed', type=int, default=None,
+                        help='seed of the random frozen encoder, so that runs with different seeds can share the cache')
+    parser.add_argument('--embedding_cache_dir', default='embedding_cache',
+                        help='where the frame embeddings of the frozen encoder get cached')
+
     parser.add_argument('--log_dir', default='LOGS/RM_LOGS', help='Training logs directory')
 
     parser.add_argument('--demo_csv', nargs='+', default=['demos/demo_infos.csv'], help='path to csv files with demo info')
@@ -366,6 +498,8 @@ def main():
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     np.random.seed(seed)
+    # tensorflow is only seeded here, so it is not imported with the module
+    import tensorflow as tf
     tf.set_random_seed(seed)
     random.seed(seed)
 
@@ -412,58 +546,86 @@ def main():
     max_demo_return = max([demo['return'] for demo in dems])
     max_demo_length = max([demo['length'] for demo in dems])
 
+    # acquiring test demos for correlations and test accuracy
+    n_test_demos = 100
+    test_dems = []
+    for dem in test_rows['demo_id']:
+        test_dems.append(get_demo(dem))
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    trainer = RewardTrainer(args, device)
+
+    if args.frozen_encoder:
+        if args.encoder_rm_id is not None:
+            registry = RewardModelRegistry(os.path.join(args.save_dir, 'rm_registry.sqlite'))
+            trainer.net.load_encoder(registry.get_path(args.encoder_rm_id), device)
+        elif args.encoder_seed is not None:
+            torch.manual_seed(args.encoder_seed)
+            for layer in trainer.net.encoder:
+                if hasattr(layer, 'reset_parameters'):
+                    layer.reset_parameters()
+            torch.manual_seed(seed)
+        trainer.best_model = copy.deepcopy(trainer.net.state_dict())
+        # from here on the demo observations are replaced by the frame embeddings
+        logging.info('Computing frame embeddings ...')
+        dems = embed_demos(dems, trainer.net.encoder, args.embedding_cache_dir, device)
+        test_dems = embed_demos(test_dems, trainer.net.encoder, args.embedding_cache_dir, device)
+
     # make training and validation datasets separate
     # so there are two different calls to create the two datasets
 
     train_dems = dems[ : int(args.num_dems * 0.8)]
     val_dems = dems[int(args.num_dems * 0.8) : ]
 
-    train_set, _ = create_dataset(
+    train_set, train_index, _ = create_dataset(
         dems=train_dems,
         num_snippets=args.num_snippets,
         min_snippet_length=args.min_snippet_length,
         max_snippet_length=args.max_snippet_length,
         verbose=False,
         use_snippet_rewards=args.use_snippet_rewards,
-        use_clip_heuristic=args.use_clip_heuristic
+        use_clip_heuristic=args.use_clip_heuristic,
+        return_index=True
         )
 
     logging.info('Creating validation set ...')
 
-    val_set, _ = create_dataset(
+    val_set, val_index, _ = create_dataset(
         dems=val_dems,
         num_snippets=1000,
         min_snippet_length=args.min_snippet_length,
         max_snippet_length=args.max_snippet_length,
         verbose=False,
         use_snippet_rewards=args.use_snippet_rewards,
-        use_clip_heuristic=args.use_clip_heuristic
+        use_clip_heuristic=args.use_clip_heuristic,
+        return_index=True
         )
 
-    # acquiring test demos for correlations and test accuracy
     logging.info('Creating test set ...')
-    n_test_demos = 100
-    test_dems = []
-    for dem in test_rows['demo_id']:
-        test_dems.append(get_demo(dem))
-
-    test_set, true_test_acc = create_dataset(
+    test_set, test_index, true_test_acc = create_dataset(
         dems=test_dems[:n_test_demos],
         num_snippets=1000,
         min_snippet_length=args.min_snippet_length,
         max_snippet_length=args.max_snippet_length,
         verbose=False,
         use_snippet_rewards=args.use_snippet_rewards,
-        use_clip_heuristic=args.use_clip_heuristic
+        use_clip_heuristic=args.use_clip_heuristic,
+        return_index=True
     )
 
     logging.info(f'GT reward test set accuracy = {true_test_acc}')
     # train a reward network using the dems collected earlier and save it
     logging.info("Training reward model for %s ...", args.env_name)
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    trainer = RewardTrainer(args, device)
-
-    state_dict_path, accs = trainer.learn_reward(train_set, val_set, test_set, test_dems)
+    train_frames = SnippetFrames(train_dems) if args.batch_size > 1 else None
+    prefix_eval = None
+    if args.prefix_sum_eval:
+        prefix_eval = {
+            'train': (PrefixSumEvaluator(train_dems), train_index),
+            'val': (PrefixSumEvaluator(val_dems), val_index),
+            'test': (PrefixSumEvaluator(test_dems[:n_test_demos]), test_index)
+        }
+    state_dict_path, accs = trainer.learn_reward(train_set, val_set, test_set, test_dems,
+                                                 train_frames, train_index, prefix_eval)
 
     # print out predicted cumulative returns and actual returns
     # merge this successfully with anton's branch to print test return examples
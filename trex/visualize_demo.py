@@ -1,8 +1,6 @@
 import argparse
 import os
 
-import cv2
-
 from helpers.utils import get_demo
 
 vid_folder = 'Videos'
@@ -13,6 +11,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument('demo_id')
 args = parser.parse_args()
 
+# opencv is slow to import, not needed for --help
+import cv2
+
 demo = get_demo(args.demo_id)
 
 demo_id = demo['demo_id']